@@ -64,7 +64,8 @@ if sys.version_info < (REQUIRED_MAJOR, REQUIRED_MINOR):
 
 # Now import modules as we normally would
 # pylint: disable=wrong-import-position
-import os, glob, time, re
+import os, glob, time, re, logging
+import concurrent.futures
 import ofx, quotes, site_cfg, scrubber
 from control2 import *
 from rlib1 import *
@@ -76,43 +77,119 @@ userdat = site_cfg.site_cfg()
 log = create_logger('root', 'getdata.log')
 if Debug:
     log.warn("**DEBUG Enabled: See Control2.py to disable.")
-    log.debug('xfrdir = %s' % xfrdir)
+    log.debug('xfrdir = %s', xfrdir)
+
+#regex used to flag import files as processed
+_NEWFILEUID_RE = re.compile(rb'NEWFILEUID:[^\r\n]*')
+
+#site lookup tables, built on first call to getSite():  {fid: (position, sitename)}, {bankid: (position, sitename)}
+#position = order in sites.dat, so the first matching site still wins
+_fid_index = None
+_bankid_index = None
+
+def _tagVal(buf, low, tag):
+    # return the value following <tag> in buf, up to the next '<' or white space
+    # low = buf.lower(), tag = lowercase tag name.  returns 'undefined' if not found
+    i = low.find('<' + tag + '>')
+    if i < 0: return 'undefined'
+    j = k = i + len(tag) + 2
+    while k < len(buf):
+        if buf[k] == '<' or buf[k].isspace(): return buf[j:k]
+        k += 1
+    return 'undefined'
 
 def getSite(ofx):
     # find matching site entry for ofx
     # matches on FID or BANKID value found in ofx and in sites list
 
     #get fid value from ofx
+    #FID and BANKID are found near the top of a statement, so only the first 8KB is searched.
     site = None
-    p = re.compile(r'<FID>(.*?)[<\s]',re.IGNORECASE | re.DOTALL)
-    r = p.search(ofx)
-    fid = r.groups()[0] if r else 'undefined'
-    p = re.compile(r'<BANKID>(.*?)[<\s]',re.IGNORECASE | re.DOTALL)
-    r = p.search(ofx)
-    bankid = r.groups()[0] if r else 'undefined'
+    head = ofx[:8192]
+    low = head.lower()      #import files are decoded as latin-1, so lower() keeps character positions
+    fid = _tagVal(head, low, 'fid')
+    bankid = _tagVal(head, low, 'bankid')
     sites = userdat.sites
-    if fid or bankid:
-        for s in sites:
-            if not site: site=sites[s]   #defaults to first site found, if matching fid/bankid not found
-            thisFid    = FieldVal(sites[s], 'fid')
-            thisBankid = FieldVal(sites[s], 'bankid')
-            if thisFid == fid or thisBankid == bankid:
-                site = sites[s]
-                log.info('Matched import file to site *%s*' % s)
-                break
+    global _fid_index, _bankid_index
+    if _fid_index is None:
+        _fid_index, _bankid_index = {}, {}
+        for i, s in enumerate(sites):
+            _fid_index.setdefault(FieldVal(sites[s], 'fid'), (i, s))
+            _bankid_index.setdefault(FieldVal(sites[s], 'bankid'), (i, s))
+
+    if sites:
+        site = next(iter(sites.values()))   #defaults to first site found, if matching fid/bankid not found
+        matches = [m for m in (_fid_index.get(fid), _bankid_index.get(bankid)) if m]
+        if matches:
+            s = min(matches)[1]
+            site = sites[s]
+            log.info('Matched import file to site *%s*', s)
 
     return site
 
+def _unlink(path):
+    #delete a file, ignoring errors
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def importFile(f, fname):
+    # process a single file from the import folder.  runs on a worker thread.
+    # f = full path, fname = base filename.extension
+    # log messages are returned to the caller (instead of logged here) to keep the log in file order
+    # returns: msgs, ofxList entry (None if f isn't an ofx file)
+    msgs = []
+    bname, bext = os.path.splitext(fname)   #basename w/o extension, file extension
+    #the file is handled as raw bytes (the ofx header is ascii), so it's written back unchanged
+    #except for the NEWFILEUID flag.  latin-1 maps bytes 1:1 to chars for getSite()
+    with open(f, 'rb', buffering=1<<20) as ifile:
+        dat = ifile.read()
+
+    #only import if it looks like an ofx file
+    if validOFX_bytes(dat) != '':
+        return msgs, None
+
+    msgs.append("Importing %s" % fname)
+    scrubbed = False
+    if b'NEWFILEUID:PSIMPORT' not in dat[:200]:
+        #only scrub if it hasn't already been imported (and hence, scrubbed)
+        #the scrub routines (incl. custom scrub_*.py modules) keep module-level state, so run one at a time
+        try:
+            with scrubber.scrubLock:
+                site = getSite(dat[:8192].decode('latin-1'))
+                scrubber.scrub(f, site)
+            scrubbed = True
+        except:
+            msgs.append('No site defined for %s in sites.dat: skipping scrub routines' % fname)
+
+    #set NEWFILEUID:PSIMPORT to flag the file as having already been imported/scrubbed
+    #don't want to accidentally scrub twice
+    #the file only needs to be re-read if the scrubber rewrote it
+    ofx = dat
+    if scrubbed:
+        with open(f, 'rb', buffering=1<<20) as ifile:
+            ofx = ifile.read()
+    ofx2, n = _NEWFILEUID_RE.subn(b'NEWFILEUID:PSIMPORT', ofx, count=1)
+    if n and ofx2 != ofx:   #skip the write if the file is already flagged
+        with open(f, 'wb', buffering=1<<20) as ofile:
+            ofile.write(ofx2)
+    #preserve original file type but save w/ ofx extension
+    outname = xfrdir + (fname if bext=='.ofx' else fname+'.ofx')
+    os.rename(f, outname)
+    msgs.append('%s saved to %s' % (fname, outname))
+    return msgs, ['import file', '', outname]
+
 if __name__=="__main__":
 
     stat1 = True    #overall status flag across all operations (true == no errors getting data)
     quotesExist = False
     print('')
-    log.info(AboutTitle + ", Ver: " + AboutVersion)
+    log.info('%s, Ver: %s', AboutTitle, AboutVersion)
 
-    if Debug:
+    if Debug and log.isEnabledFor(logging.DEBUG):
         httpsVerify = False if os.environ.get('PYTHONHTTPSVERIFY','')=='0' else True
-        log.debug('httpsVerify ' + 'ON' if httpsVerify else 'OFF')
+        log.debug('httpsVerify %s', 'ON' if httpsVerify else 'OFF')
 
     doit='Y'
     if userdat.promptStart:
@@ -126,7 +203,7 @@ if __name__=="__main__":
                 p = int2(input("Download interval (days) [" + str(interval) + "]: "))
                 if p>0: interval = p
             except:
-                log.info("Invalid entry. Using defaultInterval=" + str(interval))
+                log.info("Invalid entry. Using defaultInterval=%s", interval)
 
         #get account info
         #AcctArray = [['SiteName', 'Account#', 'AcctType', 'UserName', 'PassWord'], ...]
@@ -140,11 +217,15 @@ if __name__=="__main__":
             AcctArray = acctDecrypt(AcctArray, pwkey)
 
         #delete old data files
-        ofxfiles = xfrdir+'*.ofx'
-        if glob.glob(ofxfiles) != []:
-            os.system("del "+ofxfiles)
+        #a large xfr folder is cleared on a thread pool, to overlap the (mostly i/o wait) unlink calls
+        ofxfiles = glob.glob(xfrdir+'*.ofx')
+        if len(ofxfiles) > 50:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+                ex.map(_unlink, ofxfiles)
+        else:
+            for p in ofxfiles: _unlink(p)
 
-        log.info("Default download interval= {0} days".format(interval))
+        log.info("Default download interval= %s days", interval)
 
         #create process Queue in the right order
         Queue = ['Accts', 'importFiles']
@@ -160,63 +241,41 @@ if __name__=="__main__":
                   log.info("No accounts have been configured. Run SETUP.PY to add accounts")
 
                 #process accounts
-                badConnects = []   #track [sitename, username] for failed connections so we don't risk locking an account
-                for acct in AcctArray:
-                    if [acct[0], acct[3]] not in badConnects:
-                        status, ofxFile = ofx.getOFX(acct, interval)
-                        if not status and userdat.skipFailedLogon:
-                            badConnects.append([acct[0], acct[3]])
-                        else:
+                #sites are downloaded in parallel.  see ofx.getOFXBatch()
+                acctResults = ofx.getOFXBatch(AcctArray, interval, userdat.maxParallelDownloads)
+                for acct, result in zip(AcctArray, acctResults):
+                    if result:
+                        status, ofxFile = result
+                        if status or not userdat.skipFailedLogon:
                             ofxList.append([acct[0], acct[1], ofxFile])
                         stat1 = stat1 and status
-                        print("")
 
             if QEntry == 'importFiles':
                 #process files from import folder [manual user downloaded files]
                 #include anything that looks like a valid ofx file regardless of extension
                 #attempts to find site entry by FID found in the ofx file
 
-                log.info('Searching %s for statements to import' % importdir)
-                for f in glob.glob(importdir+'*.*'):
-                    fname = os.path.basename(f)   #full base filename.extension
-                    bname = os.path.splitext(fname)[0]     #basename w/o extension
-                    bext  = os.path.splitext(fname)[1]     #file extension
-                    with open(f) as ifile:
-                        dat = ifile.read()
-
-                    #only import if it looks like an ofx file
-                    if validOFX(dat) == '':
-                        log.info("Importing %s" % fname)
-                        if 'NEWFILEUID:PSIMPORT' not in dat[:200]:
-                            #only scrub if it hasn't already been imported (and hence, scrubbed)
-                            try:
-                                site = getSite(dat)
-                                scrubber.scrub(f, site)
-                            except:
-                                log.info('No site defined for %s in sites.dat: skipping scrub routines' % fname)
-
-
-                        #set NEWFILEUID:PSIMPORT to flag the file as having already been imported/scrubbed
-                        #don't want to accidentally scrub twice
-                        with open(f, 'r', encoding='utf-8', newline='') as ifile:
-                            ofx = ifile.read()
-                        p = re.compile(r'NEWFILEUID:.*')
-                        ofx2 = p.sub('NEWFILEUID:PSIMPORT', ofx)
-                        if ofx2:
-                            with open(f, 'w') as ofile:
-                                ofile.write(ofx2)
-                        #preserve original file type but save w/ ofx extension
-                        outname = xfrdir+fname + ('' if bext=='.ofx' else '.ofx')
-                        os.rename(f, outname)
-                        ofxList.append(['import file', '', outname])
-                        log.info('%s saved to %s' % (fname, outname))
+                log.info('Searching %s for statements to import', importdir)
+                paths, fnames = [], []
+                if os.path.isdir(importdir):
+                    with os.scandir(importdir) as it:
+                        for de in it:
+                            #same set of files as glob(importdir+'*.*')
+                            if '.' in de.name and not de.name.startswith('.') and de.is_file():
+                                paths.append(de.path)
+                                fnames.append(de.name)
+
+                with concurrent.futures.ThreadPoolExecutor() as ex:
+                    for msgs, entry in ex.map(importFile, paths, fnames):
+                        for msg in msgs: log.info(msg)
+                        if entry: ofxList.append(entry)
 
             #get stock/fund quotes
             if QEntry == 'Quotes' and getquotes:
                 status, quoteFile1, quoteFile2, htmFileName = quotes.getQuotes()
                 z = ['Stock/Fund Quotes','',quoteFile1]
                 stat1 = stat1 and status
-                if glob.glob(quoteFile1) != []:
+                if os.path.isfile(quoteFile1):
                     ofxList.append(z)
                 else: quotesExist=False
                 print("")
@@ -226,38 +285,42 @@ if __name__=="__main__":
 
         if len(ofxList) > 0:
             log.info('Downloads completed.')
-            verify = False
             gogo = 'Y'
-            if userdat.combineofx and gogo != 'V':
+            cfile = ''
+            #nothing to combine if there's only one statement
+            if userdat.combineofx and gogo != 'V' and len(ofxList) > 1:
                 cfile=combineOfx(ofxList)       #create combined file
 
             if doit == 'I' or Debug:
                 gogo = input('Upload results to Money? (Y/N/V=Verify) [Y] ').upper()
                 gogo = 'Y' if gogo=='' else gogo[:1]    #first letter
 
+            verify = (gogo == 'V')
             if gogo == 'N': log.info('Results not sent to Money.  User cancelled.')
 
             if gogo in 'YV':
-                if glob.glob(quoteFile2) != []:
-                    if Debug: log.debug("Importing ForceQuotes statement: %s" % quoteFile2)
+                if quoteFile2 and os.path.isfile(quoteFile2):
+                    if Debug: log.debug("Importing ForceQuotes statement: %s", quoteFile2)
                     runFile(quoteFile2)  #force transactions for MoneyUK
                     input('ForceQuote statement loaded.  Accept in Money and press <Enter> to continue.')
 
                 log.info('Sending statement(s) to Money...')
-                if userdat.combineofx and cfile and gogo != 'V':
+                if userdat.combineofx and cfile and not verify:
                     runFile(cfile)
                 else:
+                    promptTpl = 'Upload {0} : {1} (Y/N) '
                     for file in ofxList:
                         upload = True
-                        if gogo == 'V':
+                        if verify:
                             #file[0] = site, file[1] = accnt#, file[2] = ofxFile
-                            upload = (input('Upload ' + file[0] + ' : ' + file[1] + ' (Y/N) ').upper() == 'Y')
+                            upload = (input(promptTpl.format(file[0], file[1])).upper() == 'Y')
 
                         if upload:
-                           log.info("Importing " + file[2])
+                           log.info("Importing %s", file[2])
                            runFile(file[2])
 
-                        time.sleep(0.5)   #slight delay, to force load order in Money
+                        if userdat.uploadGapMs:
+                            time.sleep(userdat.uploadGapMs/1000)   #slight delay, to force load order in Money (UploadGapMs in sites.dat)
 
             #ask to show quotes.htm if defined in sites.dat
             if userdat.askquotehtm and quotesExist:
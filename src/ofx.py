@@ -67,24 +67,95 @@
 #03Dec2023 cgn
 #   - Update to python3
 
-import time, os, sys, urllib.parse, glob, random, re
+import time, os, sys, urllib.parse, urllib.request, glob, uuid, re, mmap
+import concurrent.futures, dataclasses, functools
 import requests, collections
-import scrubber, site_cfg
+from requests.adapters import HTTPAdapter
+try:
+    #optional: httpx w/ HTTP/2 support (pip install httpx[http2]), used when UseHTTP2 is set in sites.dat
+    import httpx, h2
+except ImportError:
+    httpx = None
+import site_cfg
 from control2 import *
 from rlib1 import *
 
-if Debug:
-    import traceback
-
 #define some function pointers
-join = str.join
 argv = sys.argv
 
 #define some globals
 userdat = site_cfg.site_cfg()
 
+#fiddler env vars config for debug.  HTTPSPROXY auto-recognized by Requests, but not PYTHONHTTPSVERIFY
+#   set PYTHONHTTPSVERIFY=0
+#   set HTTPSPROXY="https://127.0.0.1:8888"
+_httpsVerify = False if os.environ.get('PYTHONHTTPSVERIFY','')=='0' else True
+
+#send OFX requests w/ httpx (HTTP/2) instead of requests?  opt-in, since servers see a different client
+_useHttpx = bool(httpx) and userdat.useHTTP2
+
+#shared connection pool for all OFX clients.  each client gets its own session (so
+#cookies and headers aren't shared between logins), but keep-alive connections are reused
+if _useHttpx:
+    #a client w/ an explicit transport ignores proxy env vars, so pass the https proxy along here
+    _httpxTransport = httpx.HTTPTransport(http2=True, verify=_httpsVerify,
+                        proxy=urllib.request.getproxies().get('https'),
+                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+else:
+    _httpAdapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+
+#xml processing instructions like <? content...content ?>.  non-greedy, so we don't eat OFX data
+#between the first <? and the last ?> when a response is all on one line
+_XML_HDR_RE = re.compile(rb'<\?.*?\?>')
+#translate tables for deleting characters.  str.translate does the scan in C
+_BADCHARS_TBL = str.maketrans('', '', ' &\\/:*?"!=|()')   #illegal WinFile characters (and '&') for file names
+_TRNUID_RE = re.compile(rb'<TRNUID>\s*([^<\s]+)', re.I)
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SiteCfg:
+    #site settings used for OFX requests, resolved once from a sites.dat entry (see _siteCfg)
+    url:         str
+    ofxver:      str
+    fiorg:       str
+    fid:         str
+    appid:       str
+    appver:      str
+    clientuid:   str
+    useragent:   str
+    dtacctup:    str
+    delay:       float
+    mininterval: int
+    caps:        tuple
+    bankid:      str
+    brokerid:    str
+    batchstmt:   bool
+
+    @classmethod
+    def fromSite(cls, site):
+        #site = dict entry from site_cfg.sites
+        vals = {f.name: FieldVal(site, f.name) for f in dataclasses.fields(cls)}
+        vals['caps'] = tuple(vals['caps'])
+        return cls(**vals)
+
+@functools.lru_cache(maxsize=None)
+def _siteCfg(sitename):
+    return SiteCfg.fromSite(userdat.sites[sitename])
+
+@functools.lru_cache(maxsize=None)
+def _httpHeaders(useragent):
+    #request headers for a site.  Host and Content-Length are auto-created by requests/httpx
+    header = collections.OrderedDict()
+    header['Content-Type'] = 'application/x-ofx'
+    header['Connection']   = 'Keep-Alive'
+    header['Accept'] = 'application/x-ofx'
+    if useragent is None:                   #default
+        header['User-Agent'] = 'InetClntApp/3.0'
+    elif useragent.lower()!='none':
+        header['User-Agent'] = useragent
+    return header
+
 class OFXClient:
-    #Encapsulate an ofx client, site is a dict containg site configuration
+    #Encapsulate an ofx client, site is a dict containg site configuration (or a resolved SiteCfg)
     def __init__(self, site, user, password):
         global log
         log = logging.getLogger('root')
@@ -93,51 +164,100 @@ class OFXClient:
         self.status = True
         self.user = user
         self.site = site
-        self.ofxver = FieldVal(site,"ofxver")
-        self.url = FieldVal(self.site,"url")
-        self.dtacctup = FieldVal(self.site,"dtacctup") or '19700101'
-        self.clientuid =  FieldVal(self.site,"clientuid")  #<optional> user-entered clientUID for site
+        self.cfg = site if isinstance(site, SiteCfg) else SiteCfg.fromSite(site)
+        self.ofxver = str(self.cfg.ofxver)
+        self.ofxver_int = int(self.ofxver)
+        self.is_v2 = self.ofxver_int >= 200
+        self.url = self.cfg.url
+        self.dtacctup = self.cfg.dtacctup or '19700101'
+        self.clientuid =  self.cfg.clientuid  #<optional> user-entered clientUID for site
         #if the user hasn't defined a clientUID and ofxVer>102, auto-create and save
-        if self.clientuid is None and int(self.ofxver) > 102:
+        if self.clientuid is None and self.ofxver_int > 102:
             self.clientuid = clientUID(self.url, self.user)
-        self.useragent  =  FieldVal(self.site,"useragent")
+        self.useragent  =  self.cfg.useragent
 
         #example: url='https://test.ofx.com/my/script'
         #path='//test.ofx.com/my/script';  Host= 'test.ofx.com' ; Selector= '/my/script'
-        self.urlHost = urllib.parse.urlparse(self.url).netloc
-        self.urlSelector = urllib.parse.urlparse(self.url).path
+        parts = urllib.parse.urlsplit(self.url)
+        self.urlHost = parts.netloc
+        self.urlSelector = parts.path or '/'
 
         if Debug:
             log.debug('urlHost    :' + self.urlHost)
             log.debug('urlSelector:' + self.urlSelector)
         self.cookie = 3
 
+        #DTASOF timestamp for investment requests (see _dtNow)
+        self._dtnow_t = time.time()
+        self._dtnow = time.strftime("%Y%m%d%H%M%S", time.localtime(self._dtnow_t))
+
+        if _useHttpx:
+            #follow redirects, like requests does.  httpx merges its own default headers (User-Agent,
+            #Accept-Encoding: gzip) into the client headers, so replace them to send the same headers as requests
+            self.session = httpx.Client(transport=_httpxTransport, timeout=httpx.Timeout(60.0, connect=5.0),
+                                        follow_redirects=True)
+            self.session.headers.clear()
+            self.session.headers.update(_httpHeaders(self.useragent))
+            self.session.headers['Accept-Encoding'] = 'identity'
+        else:
+            self.session = requests.Session()
+            self.session.mount('https://', _httpAdapter)
+            self.session.headers = _httpHeaders(self.useragent)
+
+        #OFX 2.x (xml) and 1.x (sgml) headers
+        self._xml_hdr = f"""<?xml version="1.0" encoding="utf-8" ?>
+                     <?OFX OFXHEADER="200" VERSION="{self.ofxver}" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>"""
+        self._sgml_hdr = '\r\n'.join(("OFXHEADER:100",
+                                "DATA:OFXSGML",
+                                f"VERSION:{self.ofxver}",
+                                "SECURITY:NONE",
+                                "ENCODING:USASCII",
+                                "CHARSET:1252",
+                                "COMPRESSION:NONE",
+                                "OLDFILEUID:NONE",
+                                "NEWFILEUID:NONE",
+                                ""))
+
+        #the header and signon blocks are the same for every query from this client, except for
+        #the DTCLIENT timestamp.  build them once, and split the signon around DTCLIENT's value
+        self._headerStr = self._header()
+        self._signOnPre, self._signOnPost = self._signOn('\0').split('\0')
+
+    def _dtNow(self):
+        #cached local time stamp.  refreshed if older than a minute, for long-running batches
+        t = time.time()
+        if t - self._dtnow_t > 60:
+            self._dtnow_t = t
+            self._dtnow = time.strftime("%Y%m%d%H%M%S", time.localtime(t))
+        return self._dtnow
+
     def _cookie(self):
         self.cookie += 1
         return str(self.cookie)
 
     #Generate signon message
-    def _signOn(self):
-        site = self.site
-        ver  = self.ofxver
+    def _signOn(self, dtclient=None):
+        #dtclient = DTCLIENT value (default = now)
+        cfg = self.cfg
+        ver = self.ofxver
 
         clientuid=''
-        if int(ver) > 102:
+        if self.ofxver_int > 102:
             #include clientuid if version=103+, otherwise the server may reject the request
             clientuid = OfxField("CLIENTUID", self.clientuid, ver)
 
-        fidata = [OfxField("ORG",FieldVal(site,"fiorg"), ver)]
-        fidata += [OfxField("FID",FieldVal(site,"fid"), ver)]
+        fidata = [OfxField("ORG",cfg.fiorg, ver)]
+        fidata += [OfxField("FID",cfg.fid, ver)]
         rtn = OfxTag("SIGNONMSGSRQV1",
                 OfxTag("SONRQ",
                 #OfxField("DTCLIENT",dateTimeStr(utc=True, tz=True), ver),
-                OfxField("DTCLIENT",dateTimeStr(), ver),
+                OfxField("DTCLIENT",dtclient or dateTimeStr(), ver),
                 OfxField("USERID",self.user, ver),
                 OfxField("USERPASS",self.password, ver),
                 OfxField("LANGUAGE","ENG", ver),
                 OfxTag("FI", *fidata),
-                OfxField("APPID",FieldVal(site,"APPID"), ver),
-                OfxField("APPVER", FieldVal(site,"APPVER"), ver),
+                OfxField("APPID",cfg.appid, ver),
+                OfxField("APPVER", cfg.appver, ver),
                 clientuid
                 ))
         return rtn
@@ -146,10 +266,13 @@ class OFXClient:
         req = OfxTag("ACCTINFORQ",OfxField("DTACCTUP",self.dtacctup))
         return self._message("SIGNUP","ACCTINFO",req)
 
-    def _bareq(self, bankid, acctid, dtstart, acct_type):
-        site=self.site
+    def _bareq(self, bankid, accts, dtstart):
+        #accts = [(acctid, acct_type),...].  one statement transaction per account
+        return self._message("BANK","STMT", *[self._stmtrq(bankid, acctid, dtstart, acct_type) for acctid, acct_type in accts])
+
+    def _stmtrq(self, bankid, acctid, dtstart, acct_type):
         ver=self.ofxver
-        req = OfxTag("STMTRQ",
+        return OfxTag("STMTRQ",
                 OfxTag("BANKACCTFROM",
                 OfxField("BANKID",bankid, ver),
                 OfxField("ACCTID",acctid, ver),
@@ -158,22 +281,25 @@ class OFXClient:
                 OfxField("DTSTART",dtstart, ver),
                 OfxField("INCLUDE","Y", ver))
                 )
-        return self._message("BANK","STMT",req)
 
-    def _ccreq(self, acctid, dtstart):
-        site=self.site
+    def _ccreq(self, acctids, dtstart):
+        return self._message("CREDITCARD","CCSTMT", *[self._ccstmtrq(acctid, dtstart) for acctid in acctids])
+
+    def _ccstmtrq(self, acctid, dtstart):
         ver  = self.ofxver
-        req = OfxTag("CCSTMTRQ",
+        return OfxTag("CCSTMTRQ",
               OfxTag("CCACCTFROM",OfxField("ACCTID",acctid, ver)),
               OfxTag("INCTRAN",
               OfxField("DTSTART",dtstart, ver),
               OfxField("INCLUDE","Y", ver)))
-        return self._message("CREDITCARD","CCSTMT",req)
 
-    def _invstreq(self, brokerid, acctid, dtstart):
-        dtnow = time.strftime("%Y%m%d%H%M%S",time.localtime())
+    def _invstreq(self, brokerid, acctids, dtstart):
+        return self._message("INVSTMT","INVSTMT", *[self._invstmtrq(brokerid, acctid, dtstart) for acctid in acctids])
+
+    def _invstmtrq(self, brokerid, acctid, dtstart):
+        dtnow = self._dtNow()
         ver  = self.ofxver
-        req = OfxTag("INVSTMTRQ",
+        return OfxTag("INVSTMTRQ",
                 OfxTag("INVACCTFROM",
                     OfxField("BROKERID", brokerid, ver),
                     OfxField("ACCTID",acctid, ver)),
@@ -185,111 +311,94 @@ class OFXClient:
                     OfxField("DTASOF", dtnow, ver),
                     OfxField("INCLUDE","Y", ver)),
                 OfxField("INCBAL","Y", ver))
-        return self._message("INVSTMT","INVSTMT",req)
 
-    def _message(self,msgType,trnType,request):
-        site = self.site
+    def _message(self,msgType,trnType,*requests):
+        #message set w/ a transaction for each request.  TRNUIDs are saved (in order) to match
+        #transactions in a multi-account response (see getOFXMulti)
         ver  = self.ofxver
+        self.trnuids = [ofxUUID() for r in requests]
         return OfxTag(msgType+"MSGSRQV1",
-               OfxTag(trnType+"TRNRQ",
-               OfxField("TRNUID",ofxUUID(), ver),
-               request))
+               *[OfxTag(trnType+"TRNRQ",
+                 OfxField("TRNUID",trnuid, ver),
+                 request) for trnuid, request in zip(self.trnuids, requests)])
 
     def _header(self):
-        site = self.site
-        if self.ofxver[0]=='2':
-            rtn = """<?xml version="1.0" encoding="utf-8" ?>
-                     <?OFX OFXHEADER="200" VERSION="%ofxver%" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>"""
-            rtn = rtn.replace('%ofxver%', self.ofxver)
+        return self._xml_hdr if self.is_v2 else self._sgml_hdr
 
-        else:
-            rtn = join('\r\n',["OFXHEADER:100",
-                           "DATA:OFXSGML",
-                           "VERSION:" + self.ofxver,
-                           "SECURITY:NONE",
-                           "ENCODING:USASCII",
-                           "CHARSET:1252",
-                           "COMPRESSION:NONE",
-                           "OLDFILEUID:NONE",
-                           "NEWFILEUID:NONE",
-                           ""])
-        return rtn
+    def _signOnNow(self):
+        #cached signon block, w/ current DTCLIENT
+        return self._signOnPre + dateTimeStr() + self._signOnPost
+
+    def _query(self, request):
+        #header + <OFX> block w/ current signon and the request message
+        return f"{self._headerStr}\r\n<OFX>\r\n{self._signOnNow()}\r\n{request}\r\n</OFX>"
 
     def baQuery(self, bankid, acctid, dtstart, acct_type):
         #Bank account statement request
-        return join('\r\n',
-                    [self._header(),
-                     OfxTag("OFX",
-                          self._signOn(),
-                          self._bareq(bankid, acctid, dtstart, acct_type)
-                          )
-                    ]
-                )
+        return self._query(self._bareq(bankid, [(acctid, acct_type)], dtstart))
+
+    def baQueryMulti(self, bankid, accts, dtstart):
+        #Bank account statement requests for accts = [(acctid, acct_type),...]
+        return self._query(self._bareq(bankid, accts, dtstart))
 
     def ccQuery(self, acctid, dtstart):
         #CC Statement request
-        return join('\r\n',[self._header(),
-                    OfxTag("OFX",
-                    self._signOn(),
-                    self._ccreq(acctid, dtstart))])
+        return self._query(self._ccreq([acctid], dtstart))
+
+    def ccQueryMulti(self, acctids, dtstart):
+        #CC Statement requests for several accounts
+        return self._query(self._ccreq(acctids, dtstart))
 
     def acctQuery(self):
-        return join('\r\n',[self._header(),
-                    OfxTag("OFX",
-                    self._signOn(),
-                    self._acctreq())])
+        return self._query(self._acctreq())
 
     def invstQuery(self, brokerid, acctid, dtstart):
-        return join('\r\n',[self._header(),
-                    OfxTag("OFX",
-                    self._signOn(),
-                    self._invstreq(brokerid, acctid, dtstart))])
+        return self._query(self._invstreq(brokerid, [acctid], dtstart))
+
+    def invstQueryMulti(self, brokerid, acctids, dtstart):
+        return self._query(self._invstreq(brokerid, acctids, dtstart))
 
     def doQuery(self,query,name):
         response=None
         try:
             errmsg= "** An ERROR occurred attempting HTTPS connection to"
-            s = requests.Session()
-
-            #fiddler env vars config for debug.  HTTPSPROXY auto-recognized by Requests, but not PYTHONHTTPSVERIFY
-            #   set PYTHONHTTPSVERIFY=0
-            #   set HTTPSPROXY="https://127.0.0.1:8888"
-            httpsVerify = False if os.environ.get('PYTHONHTTPSVERIFY','')=='0' else True
-            header = collections.OrderedDict()
-            header['Content-Type'] = 'application/x-ofx'
-            header['Host']         = self.urlHost
-            header['Content-Length'] = str(len(query))  #auto-created by requests
-            header['Connection']   = 'Keep-Alive'
-            header['Accept'] = 'application/x-ofx'
-            if self.useragent is None:                   #default
-                header['User-Agent'] = 'InetClntApp/3.0'
-            elif self.useragent.lower()!='none':
-                header['User-Agent'] = self.useragent
-            s.headers = header
+            s = self.session
 
             for i in [0,1]:
                 #retry for sites that require session cookie(s)
                 errmsg= "** An ERROR occurred sending POST request to"
-                response = s.post(self.url, data=query, verify=httpsVerify)
+                if _useHttpx:
+                    response = s.post(self.url, content=query)
+                else:
+                    response = s.post(self.url, data=query, verify=_httpsVerify, timeout=(5,60))
 
-                respDat = response.text
+                respDat = response.content      #raw bytes.  ofx is ascii, so skip the charset detection & decode
                 if Debug:
                     log.debug('*** SENT ***')
                     log.debug('HEADER: ' + str(response.request.headers))
-                    log.debug(response.request.body)
+                    log.debug(response.request.content if _useHttpx else response.request.body)
                     log.debug('*** RECEIVED ***')
                     log.debug('HEADER:' + str(response.headers))
-                    log.debug(respDat)
-
-                if validOFX(respDat)=='': break
-
-            if validOFX(respDat)=='':
-                #if this is a OFX 2.x response, replace the header w/ OFX 1.x
-                if self.ofxver[0] == '2':
-                    respDat = re.sub(r'<\?.*\?>', '', respDat)      #remove xml header lines like <? content...content ?>
-                    respDat = OfxSGMLHeader() + respDat.lstrip()
-
-            with open(name,"w") as f:
+                    log.debug(respDat.decode('ascii','ignore'))
+
+                valid = validOFX_bytes(respDat)==''
+                if valid: break
+
+            #if this is a OFX 2.x response, replace the header w/ OFX 1.x
+            if self.is_v2:
+                #remove xml header lines like <? content...content ?>
+                if respDat.lstrip().startswith(b'<?'):
+                    #the usual case: declarations lead the response.  cut them off w/o a regex scan.
+                    #also done if the response reports an error, since a multi-account response
+                    #may still hold good statements for the other accounts (see getOFXMulti)
+                    respDat = respDat.lstrip()
+                    while respDat.startswith(b'<?') and b'?>' in respDat:
+                        respDat = respDat.partition(b'?>')[2].lstrip()
+                    respDat = OfxSGMLHeader().encode() + respDat
+                elif valid:
+                    respDat = OfxSGMLHeader().encode() + _XML_HDR_RE.sub(b'', respDat).lstrip()
+
+            with open(name,"wb") as f:
                 f.write(respDat)
 
         except Exception as e:
@@ -298,28 +407,33 @@ class OFXClient:
 
             if response:
                 log.info('HTTPS ResponseCode  : ' + str(response.status_code))
-                log.info('HTTPS ResponseReason: ' + response.reason)
-
-        if response: response.close()
+                log.info('HTTPS ResponseReason: ' + (response.reason_phrase if _useHttpx else response.reason))
 #------------------------------------------------------------------------------
 
 def getOFX(account, interval):
+    status, ofxFileName = getOFXMulti([account], interval)[0]
+    return status, ofxFileName
 
-    sitename   = account[0]
-    _acct_num  = account[1]             #account value defined in sites.dat
-    acct_type  = account[2]
-    user       = account[3]
-    password   = account[4]
-    acct_num = _acct_num.split(':')[0]  #bank account# (stripped of :xxx version)
+def getOFXMulti(accounts, interval):
+    #download statements for one or more accounts w/ the same site and login.  more than one account
+    #is requested in a single OFX message (a transaction per account), and the response is split into
+    #a file per account.  returns a list of (status, ofxFileName) in the same order as accounts
+
+    sitename   = accounts[0][0]
+    user       = accounts[0][3]
+    password   = accounts[0][4]
+    _acct_nums = [acct[1] for acct in accounts]                #account values defined in sites.dat
+    acct_nums  = [a.split(':')[0] for a in _acct_nums]         #bank account#s (stripped of :xxx version)
 
     global log
     log = logging.getLogger('root')
 
     #get site and other user-defined data
     site = userdat.sites[sitename]
+    cfg = _siteCfg(sitename)
 
     #set the interval (days)
-    minInterval = FieldVal(site,'mininterval')    #minimum interval (days) defined for this site (optional)
+    minInterval = cfg.mininterval    #minimum interval (days) defined for this site (optional)
     if minInterval:
          interval = max(minInterval, interval)    #use the longer of the two
 
@@ -328,87 +442,187 @@ def getOFX(account, interval):
     dtnow = time.strftime("%Y%m%d%H%M%S",time.localtime())
 
     #add delay prior to connect if defined for site
-    delay = FieldVal(site, "DELAY")
+    delay = cfg.delay
     if delay > 0.0:
         log.info('Delaying %.1f seconds...' % delay)
         time.sleep(delay)
 
-    client = OFXClient(site, user, password)
-    log.info('%s: %s: Getting records since: %s' % (sitename,acct_num,dtstart))
-
-    status = True
+    client = OFXClient(cfg, user, password)
+    log.info('%s: %s: Getting records since: %s' % (sitename,', '.join(acct_nums),dtstart))
 
     #remove illegal WinFile characters from the file name (in case someone included them in the sitename)
     #Also, the os.system() call doesn't allow the '&' char, so we'll replace it too
-    sitename = ''.join(a for a in sitename if a not in ' &\/:*?"!=|()')  #first char is a space
+    sitename = sitename.translate(_BADCHARS_TBL)
 
-    ofxFileSuffix = str(random.randrange(int(1e5),int(1e6))) + ".ofx"
-    ofxFileName = xfrdir + sitename + dtnow + ofxFileSuffix
+    #uuid4 is os.urandom based, so parallel downloads (see getOFXBatch) won't pick the same suffix
+    ofxFileNames = [xfrdir + sitename + dtnow + f"{uuid.uuid4().hex[:8]}.ofx" for acct in accounts]
+    rspFileName = ofxFileNames[0]      #file for the server response
+    if len(accounts) > 1:
+        rspFileName = xfrdir + sitename + dtnow + f"{uuid.uuid4().hex[:8]}.ofx"
 
     msg = "Unknown error occurred while processing OFX request for site: " + sitename
-    
+
     try:
-        if acct_num == '':
+        trnType = None
+        if acct_nums[0] == '':
             query = client.acctQuery()
         else:
-            caps = FieldVal(site, "CAPS")
+            caps = cfg.caps
 
             if "CCSTMT" in caps:
-                query = client.ccQuery(acct_num, dtstart)
+                query = client.ccQueryMulti(acct_nums, dtstart)
+                trnType = b'CCSTMT'
             elif "INVSTMT" in caps:
                 #if we have a brokerid, use it.  Otherwise, try the fiorg value.
-                orgID = FieldVal(site, 'BROKERID')
-                if orgID == '': orgID = FieldVal(site, 'FIORG')
+                orgID = cfg.brokerid
+                if orgID == '': orgID = cfg.fiorg
                 if orgID == '':
                     msg = '** Error: Site', sitename, 'missing (REQUIRED) BrokerID or FIORG value(s).'
                     raise Exception(msg)
-                query = client.invstQuery(orgID, acct_num, dtstart)
+                query = client.invstQueryMulti(orgID, acct_nums, dtstart)
+                trnType = b'INVSTMT'
 
             elif "BASTMT" in caps:
-                bankid = FieldVal(site, "BANKID")
+                bankid = cfg.bankid
                 if bankid == '':
                     msg='** Error: Site', sitename, 'missing (REQUIRED) BANKID value.'
                     raise Exception(msg)
-                query = client.baQuery(bankid, acct_num, dtstart, acct_type)
+                query = client.baQueryMulti(bankid, [(n, acct[2]) for n, acct in zip(acct_nums, accounts)], dtstart)
+                trnType = b'STMT'
 
             else:
                msg='** Error: Site', sitename, 'missing (REQUIRED) AcctType value.'
                raise Exception(msg)
 
         #do the deed
-        client.doQuery(query, ofxFileName)
-        if not client.status: return False, ''
-
-        #check the ofx file and make sure it looks valid (contains header and <ofx>...</ofx> blocks)
-        if glob.glob(ofxFileName) == []:
-            status = False  #no ofx file?
-        else:
-            f = open(ofxFileName,'r')
-            content = f.read().upper()
-            f.close
+        client.doQuery(query, rspFileName)
+        if not client.status: return [(False, '')] * len(accounts)
 
-            if acct_num != _acct_num:
-                #replace bank account number w/ value defined in sites.dat
-                content = content.replace('<ACCTID>'+acct_num, '<ACCTID>'+ _acct_num)
-                f = open(ofxFileName,'w')
-                f.write(content)
-                f.close()
+        if len(accounts) > 1 and os.path.isfile(rspFileName):
+            with open(rspFileName,'rb') as f:
+                rsp = f.read()
+            os.remove(rspFileName)
+            _splitStmtRS(rsp, trnType, client.trnuids, ofxFileNames)
 
-            content = ''.join(a for a in content if a not in '\r\n ')  #strip newlines & spaces
-            msg = validOFX(content)  #checks for valid format and error messages
+    except Exception as e:
+        log.exception(msg)
 
-            if msg != '':
-                #throw exception and exit
-                raise Exception(msg)
+        if glob.glob(rspFileName) != []:
+           log.info('**  Review ' + rspFileName + ' for possible clues.')
+
+        return [(False, ofxFileName) for ofxFileName in ofxFileNames]
+
+    return [(_checkOFX(ofxFileName, acct_num, _acct_num, site, sitename), ofxFileName)
+                for ofxFileName, acct_num, _acct_num in zip(ofxFileNames, acct_nums, _acct_nums)]
+
+def _splitStmtRS(rsp, trnType, trnuids, ofxFileNames):
+    #split a response w/ several <trnType>TRNRS transactions into a file per request (matched by TRNUID).
+    #each file gets the response's header + signon, and the matching transaction.
+    #if the response has no transactions (e.g., signon error), each file gets the full response
+    blocks = list(re.finditer(rb'<%sTRNRS>.*?</%sTRNRS>' % (trnType, trnType), rsp, re.I | re.S))
+    if not blocks:
+        for ofxFileName in ofxFileNames:
+            with open(ofxFileName,'wb') as f:
+                f.write(rsp)
+        return
+
+    head = rsp[:blocks[0].start()]
+    tail = rsp[blocks[-1].end():]
+    trnrs = {}
+    for b in blocks:
+        uid = _TRNUID_RE.search(b.group(0))
+        if uid: trnrs[uid.group(1).decode('ascii','ignore').upper()] = b.group(0)
+
+    for trnuid, ofxFileName in zip(trnuids, ofxFileNames):
+        #no file is written if the server didn't answer the request.  _checkOFX() flags it
+        if trnuid.upper() in trnrs:
+            with open(ofxFileName,'wb') as f:
+                f.write(head + trnrs[trnuid.upper()] + tail)
+
+def _checkOFX(ofxFileName, acct_num, _acct_num, site, sitename):
+    #check the ofx file and make sure it looks valid (contains header and <ofx>...</ofx> blocks),
+    #then scrub it.  returns status
+    msg = "Unknown error occurred while processing OFX request for site: " + sitename
+    try:
+        if not os.path.isfile(ofxFileName):
+            log.info('%s: %s: No statement received' % (sitename, acct_num))
+            return False  #no ofx file?
+
+        #check for valid format and error messages
+        if acct_num != _acct_num:
+            #replace bank account number w/ value defined in sites.dat
+            with open(ofxFileName,'rb') as f:
+                raw = f.read()
+            raw = raw.replace(b'<ACCTID>'+acct_num.encode(), b'<ACCTID>'+_acct_num.encode())
+            with open(ofxFileName,'wb') as f:
+                f.write(raw)
+            msg = validOFX_bytes(raw)
+
+        elif os.path.getsize(ofxFileName) == 0:
+            msg = validOFX_bytes(b'')     #can't map an empty file
 
-            #cleanup the file if needed
+        else:
+            #no rewrite needed.  scan a read-only map of the file, w/o copying it into memory
+            with open(ofxFileName,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                msg = validOFX_bytes(mm)
+
+        if msg != '':
+            #throw exception and exit
+            raise Exception(msg)
+
+        #cleanup the file if needed.  scrubber is imported on first use (not needed to list accounts in Setup)
+        #site groups download in parallel (see getOFXBatch), so scrub one file at a time
+        import scrubber
+        with scrubber.scrubLock:
             scrubber.scrub(ofxFileName, site)
 
     except Exception as e:
-        status = False
         log.exception(msg)
 
         if glob.glob(ofxFileName) != []:
            log.info('**  Review ' + ofxFileName + ' for possible clues.')
-
-    return status, ofxFileName
+        return False
+
+    return True
+
+def _getOFXGroup(accts, interval):
+    #download statements for a list of (index, account) entries for the same site, in order.
+    #if a connection fails for a user and skipFailedLogon is set, skip that user's other
+    #accounts at the site, so we don't risk locking the account.
+    #if the site has batchStmt set, accounts w/ the same login are requested together (see getOFXMulti)
+    batch = accts and _siteCfg(accts[0][1][0]).batchstmt
+    logins = {}
+    for i, acct in accts:
+        key = (acct[3], acct[4]) if batch and acct[1] != '' else (i,)
+        logins.setdefault(key, []).append((i, acct))
+
+    results = []
+    badConnects = []   #usernames w/ failed connections
+    for login in logins.values():
+        if login[0][1][3] in badConnects: continue
+        rslt = getOFXMulti([acct for i, acct in login], interval)
+        results += [(i, r) for (i, acct), r in zip(login, rslt)]
+        if userdat.skipFailedLogon and not all(status for status, ofxFile in rslt):
+            badConnects.append(login[0][1][3])
+        print("")
+    return results
+
+def getOFXBatch(accounts, interval, max_workers=8):
+    #call getOFX() for a list of accounts, downloading from different sites in parallel
+    #accounts for the same site are processed in order by a single worker, so site DELAY settings
+    #still apply between requests
+    #returns a list of (status, ofxFileName) in the same order as accounts.
+    #entries are None for accounts skipped after a failed logon
+    groups = {}
+    for i, acct in enumerate(accounts):
+        groups.setdefault(acct[0], []).append((i, acct))
+
+    results = [None] * len(accounts)
+    if not groups: return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as ex:
+        futures = [ex.submit(_getOFXGroup, g, interval) for g in groups.values()]
+        for future in concurrent.futures.as_completed(futures):
+            for i, result in future.result():
+                results[i] = result
+
+    return results
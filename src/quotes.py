@@ -78,13 +78,41 @@
 # 25May2023*rlc
 #   -Update to use Yahoo v10 service and cleanup json parse to remove csv-oriented format
 
-import os, requests, re, json, pickle
+import os, requests, re, pickle, csv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import concurrent.futures
+from itertools import chain
+try:
+    #optional: faster json decoder.  falls back to the standard library if not installed
+    import orjson as _json
+except ImportError:
+    import json as _json
 import site_cfg
 from control2 import *
 from rlib1 import *
 from datetime import datetime, timedelta
 
-join = str.join
+#Yahoo quote api that takes a list of symbols.  see fetchYahooBatch()
+YahooBatchURL  = 'https://query1.finance.yahoo.com/v7/finance/quote'
+YahooBatchSize = 20          #max symbols per request
+
+_ILLEGAL_CHARS_RE = re.compile(r"[^a-zA-Z0-9 ,.-]+")    #chars to strip from security names
+
+def fetchYahooQuote(ticker, crumb):
+    #read the Yahoo json data api for one ticker, and return its parsed 'price' dict.  raises on error.
+    jsonURL = (YahooURL+'&crumb={crumb}').format(ticker=ticker, crumb=crumb)
+    if Debug: log.debug('Reading ' + jsonURL)
+    response = yahooSession.get(jsonURL)
+    pdata = _json.loads(response.content)      #raw bytes.  no str decode needed
+    return pdata['quoteSummary']['result'][0]['price']
+
+def _tryFetchYahooQuote(ticker):
+    #fetchYahooQuote() for a worker thread.  returns the exception instead of raising it
+    try:
+        return fetchYahooQuote(ticker, yahooCrumb)
+    except Exception as e:
+        return e
 
 class Security:
     """
@@ -96,6 +124,10 @@ class Security:
         status, source, ticker, name, price, quoteTime, pclose, pchange
     """
 
+    #fixed attribute set (no per-instance __dict__).  add any new field here.
+    __slots__ = ('ticker','multiplier','symbol','status','source','name','price','pchange',
+                 'datetime','date','time','quoteTime','pclose','quoteURL')
+
     def __init__(self, item):
         #item = {"ticker":TickerSym, 'm':multiplier, 's':symbol}
         # TickerSym = symbol to grab from Yahoo
@@ -106,12 +138,17 @@ class Security:
         self.multiplier = item['m']
         self.symbol = item['s']
         self.status = True
+        self.quoteURL = 'https://finance.yahoo.com/quote/{ticker}'.format(ticker=self.ticker)  #link to pretty view
 
-    def _removeIllegalChars(self, inputString):
-        pattern = re.compile("[^a-zA-Z0-9 ,.-]+")
-        return pattern.sub("", inputString)
+    @staticmethod
+    def _removeIllegalChars(inputString):
+        #most names are already clean.  skip building a new string for those
+        if _ILLEGAL_CHARS_RE.search(inputString) is None:
+            return inputString
+        return _ILLEGAL_CHARS_RE.sub("", inputString)
 
-    def getQuote(self):
+    def getQuote(self, quote):
+        #quote = result of _tryFetchYahooQuote() for self.ticker (price dict or exception), or None
 
         #Yahoo! Finance:
         #parse data packet from standard htm page
@@ -122,50 +159,52 @@ class Security:
         self.source='Y'
         #note: each try for a quote sets self.status=true if successful
         if eYahoo:
-            self.getYahooQuote()
+            self.getYahooQuote(quote)
             if self.status: self.source='Y'
 
+        self._logQuote()
+
+    def _logQuote(self):
         if not self.status:
             log.info('** %s: invalid quote response. Skipping.' % self.ticker)
             self.name = '*InvalidSymbol*'
         else:
             #show what we got
-            name = self.ticker
             log.info('%s: %s %s %s %s' % (self.ticker, self.price, self.date, self.time, self.pchange))
 
-
-    def getYahooQuote(self):
-        #read Yahoo json data api, and return csv
-        #returns: quote= [name, price, quoteTime, pclose, pchange], all as strings
-
-        jsonURL = (YahooURL+'&crumb={crumb}').format(ticker=self.ticker, crumb=yahooCrumb)
-        self.quoteURL = 'https://finance.yahoo.com/quote/{ticker}'.format(ticker=self.ticker)  #link to pretty view
-        if Debug: log.debug('Reading ' + jsonURL)
-        csvtxt=""
+    def _setQuote(self, name, symbol, price, pchange, quoteTime, pclose):
+        #set quote fields from Yahoo data.  price and pclose are numbers (before the multiplier is applied),
+        #pchange is a formatted % string and quoteTime is a unix timestamp
+        self.name = self._removeIllegalChars(name or '')
+        if self.name.strip()=='': self.name = symbol
+        self.price = '%.2f' % (price * self.multiplier)
+        self.pchange = pchange
+        self.datetime= datetime.fromtimestamp(quoteTime)
+        self.date=self.datetime.strftime("%m/%d/%Y")
+        self.time=self.datetime.strftime("%H:%M:%S")
+        self.quoteTime = self.datetime.strftime("%Y%m%d%H%M%S") + '[' + YahooTimeZone + ']'
+        self.pclose= '%.2f' % (pclose * self.multiplier)
+
+    def getYahooQuote(self, quote):
+        #set quote from Yahoo json data api result (see fetchYahooQuote)
         self.status=True
 
-        try:
-            response=yahooSession.get(jsonURL)
-
-        except:
+        if isinstance(quote, requests.RequestException):
             if Debug: log.debug('** Error reading %s' % self.quoteURL)
             self.status = False
 
+        elif isinstance(quote, Exception):
+            #not formatted as expected?
+            if Debug: log.debug('An error occured when parsing the Yahoo Finance response for %s' % self.ticker)
+            self.status = False
+
         if self.status:
             try:
-                ht = response.text
-                pdata = json.loads(ht)
-                quote = pdata['quoteSummary']['result'][0]['price']
-                self.name = quote['shortName'] or quote['longName'] or ''
-                self.name = self._removeIllegalChars(self.name)
-                if self.name.strip()=='': self.name = quote['symbol']
-                self.price = '%.2f' % (quote['regularMarketPrice']['raw'] * self.multiplier)
-                self.pchange = quote['regularMarketChangePercent']['fmt']
-                self.datetime= datetime.fromtimestamp(quote['regularMarketTime'])
-                self.date=self.datetime.strftime("%m/%d/%Y")
-                self.time=self.datetime.strftime("%H:%M:%S")
-                self.quoteTime = self.datetime.strftime("%Y%m%d%H%M%S") + '[' + YahooTimeZone + ']'
-                self.pclose= '%.2f' % (quote['regularMarketPreviousClose']['raw'] * self.multiplier)
+                self._setQuote(quote['shortName'] or quote['longName'], quote['symbol'],
+                               quote['regularMarketPrice']['raw'],
+                               quote['regularMarketChangePercent']['fmt'],
+                               quote['regularMarketTime'],
+                               quote['regularMarketPreviousClose']['raw'])
 
             except:
                 #not formatted as expected?
@@ -181,21 +220,21 @@ class OfxWriter:
         self.currency = currency
         self.account = account
         self.shares = shares
+        self._shares_str = str(shares)      #UNITS and MKTVAL, used for every position
+        self._zero_shares = (shares == 0)
         self.stockList = stockList
         self.mfList = mfList
         self.dtasof = self.get_dtasof()
 
     def get_dtasof(self):
         #15-Feb-2011: Use the latest quote date/time for the statement
+        #latest quote that isn't in the future.  first one wins on a tie
         today = datetime.now()
-        dtasof   = today.strftime("%Y%m%d")+'120000'    #default to today @ noon
-        lastdate = datetime(1,1,1)                      #but compare actual dates to long, long ago...
-        for ticker in self.stockList + self.mfList:
-            if ticker.datetime > lastdate and not ticker.datetime > today:
-                lastdate = ticker.datetime
-                dtasof = ticker.quoteTime
-
-        return dtasof
+        last = max((t for t in chain(self.stockList, self.mfList) if t.datetime <= today),
+                   key=lambda t: t.datetime, default=None)
+        if last is None:
+            return today.strftime("%Y%m%d")+'120000'    #default to today @ noon
+        return last.quoteTime
 
     def _signOn(self):
         """Generate server signon response message"""
@@ -214,22 +253,17 @@ class OfxWriter:
                      )
                )
 
-    def invPosList(self):
-        # create INVPOSLIST section, including all stock and MF symbols
-        posstock = []
-        for stock in self.stockList:
-            posstock.append(self._pos("stock", stock.symbol, stock.price, stock.quoteTime))
-
-        posmf = []
-        for mf in self.mfList:
-            posmf.append(self._pos("mf", mf.symbol, mf.price, mf.quoteTime))
-
-        return OfxTag("INVPOSLIST",
-                    join("", posstock),     #str.join("",StrList) = "str(0)+str(1)+str(2)..."
-                    join("", posmf))
-
+    def invPosList(self, parts):
+        # append INVPOSLIST section, including all stock and MF symbols, to parts
+        parts.append('<INVPOSLIST>\r\n')
+        parts.extend(self._pos("stock", stock.symbol, stock.price, stock.quoteTime) for stock in self.stockList)
+        parts.append('\r\n')
+        parts.extend(self._pos("mf", mf.symbol, mf.price, mf.quoteTime) for mf in self.mfList)
+        parts.append('\r\n</INVPOSLIST>')
 
     def _pos(self, type, symbol, price, quoteTime):
+        #market value is always zero, unless forcing quotes with the extra "fake" shares
+        mktval = '0.0' if self._zero_shares else str(float2(price)*self.shares)
         return OfxTag("POS" + type.upper(),
                    OfxTag("INVPOS",
                        OfxTag("SECID",
@@ -238,17 +272,17 @@ class OfxWriter:
                        ),
                        OfxField("HELDINACCT", "CASH"),
                        OfxField("POSTYPE", "LONG"),
-                       OfxField("UNITS", str(self.shares)),
+                       OfxField("UNITS", self._shares_str),
                        OfxField("UNITPRICE", price),
-                       OfxField("MKTVAL", str(float2(price)*self.shares)),
+                       OfxField("MKTVAL", mktval),
                        #OfxField("MKTVAL", "0"),     #rlc:08-2013
                        OfxField("DTPRICEASOF", quoteTime)
                    )
                )
 
-    def invStmt(self, acctid):
-        #write the INVSTMTRS section
-        stmt = OfxTag("INVSTMTRS",
+    def invStmt(self, parts, acctid):
+        #append the INVSTMTRS section to parts
+        parts.append('\r\n'.join(('<INVSTMTRS>',
                 OfxField("DTASOF", self.dtasof),
                 OfxField("CURDEF", self.currency),
                 OfxTag("INVACCTFROM",
@@ -259,37 +293,30 @@ class OfxWriter:
                     OfxField("DTSTART", self.dtasof),
                     OfxField("DTEND", self.dtasof),
                 ),
-                self.invPosList()
-               )
-
-        return stmt
-
-    def invServerMsg(self,stmt):
-        #wrap stmt in INVSTMTMSGSRSV1 tag set
-        s = OfxTag("INVSTMTTRNRS",
+                '')))
+        self.invPosList(parts)
+        parts.append('\r\n</INVSTMTRS>')
+
+    def invServerMsg(self, parts, acctid):
+        #append the statement for acctid, wrapped in INVSTMTMSGSRSV1 tag set, to parts
+        parts.append('\r\n'.join(('<INVSTMTMSGSRSV1>',
+                    '<INVSTMTTRNRS>',
                     OfxField("TRNUID",ofxUUID()),
                     OfxTag("STATUS",
                         OfxField("CODE", "0"),
                         OfxField("SEVERITY", "INFO")),
                     OfxField("CLTCOOKIE","4"),
-                    stmt)
-        return OfxTag("INVSTMTMSGSRSV1", s)
-
-    def _secList(self):
-        stockinfo = []
-        for stock in self.stockList:
-            stockinfo.append(self._info("stock", stock.symbol, stock.name, stock.price))
-
-        mfinfo = []
-        for mf in self.mfList:
-            mfinfo.append(self._info("mf", mf.symbol, mf.name, mf.price))
-
-        return OfxTag("SECLISTMSGSRSV1",
-                   OfxTag("SECLIST",
-                        join("", stockinfo),
-                        join("", mfinfo)
-                   )
-               )
+                    '')))
+        self.invStmt(parts, acctid)
+        parts.append('\r\n</INVSTMTTRNRS>\r\n</INVSTMTMSGSRSV1>')
+
+    def _secList(self, parts):
+        #append the SECLISTMSGSRSV1 section to parts
+        parts.append('<SECLISTMSGSRSV1>\r\n<SECLIST>\r\n')
+        parts.extend(self._info("stock", stock.symbol, stock.name, stock.price) for stock in self.stockList)
+        parts.append('\r\n')
+        parts.extend(self._info("mf", mf.symbol, mf.name, mf.price) for mf in self.mfList)
+        parts.append('\r\n</SECLIST>\r\n</SECLISTMSGSRSV1>')
 
     def _info(self, type, symbol, name, price):
         secInfo = OfxTag("SECINFO",
@@ -312,21 +339,27 @@ class OfxWriter:
 
         return info
 
+    def getOfxParts(self):
+        #create main OFX message block as a list of string fragments, in order
+        parts = ['<OFX>\r\n',
+                 '<!--Created by PocketSense scripts for Money-->\r\n',
+                 '<!--https://sites.google.com/site/pocketsense/home-->\r\n',
+                 self._signOn(),
+                 '\r\n']
+        self.invServerMsg(parts, self.account)
+        parts.append('\r\n')
+        self._secList(parts)
+        parts.append('\r\n</OFX>')
+        return parts
+
     def getOfxMsg(self):
-        #create main OFX message block
-        return join('', [OfxTag('OFX',
-                        '<!--Created by PocketSense scripts for Money-->',
-                        '<!--https://sites.google.com/site/pocketsense/home-->',
-                        self._signOn(),
-                        self.invServerMsg(self.invStmt(self.account)),
-                        self._secList()
-                    )])
+        return ''.join(self.getOfxParts())
 
     def writeFile(self, name):
-        f = open(name,"w")
-        f.write(OfxSGMLHeader())
-        f.write(self.getOfxMsg())
-        f.close()
+        #write the fragments straight to a large buffer, without building the whole message
+        with open(name, "w", buffering=1<<20) as f:
+            f.write(OfxSGMLHeader())
+            f.writelines(self.getOfxParts())
 
 def getYahooSession():
     #create requests session for yahoo finance
@@ -337,24 +370,34 @@ def getYahooSession():
     yCookies, cookie, crumb=None, None, None
 
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.2; Win64; x64)'}
-    if glob.glob(cookieFile):
-        #read cookie info
-        try:
-            with open(cookieFile, 'rb') as f:
-                data=pickle.load(f)
-                yahooFin = data['yahooFinance']
-                cookie = yahooFin['cookie']
-                crumb  = yahooFin['crumb']
-                expires = datetime.fromtimestamp(cookie.expires)
-                if datetime.now() > (expires - timedelta(days=1)):
-                    cookie=None
-        except Exception as e:
-            log.debug('Error loading %s' % cookieFile)
+
+    #one pooled session for the cookie, crumb and quote requests, so the connection to yahoo is reused.
+    #pool size covers the parallel quote requests in getQuotes()
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502,503,504])))
+
+    #read cookie info
+    try:
+        with open(cookieFile, 'rb') as f:
+            data=pickle.load(f)
+            yahooFin = data['yahooFinance']
+            cookie = yahooFin['cookie']
+            crumb  = yahooFin['crumb']
+            expires = datetime.fromtimestamp(cookie.expires)
+            if datetime.now() > (expires - timedelta(days=1)):
+                cookie=None
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        cookie=None
+        log.debug('Error loading %s' % cookieFile)
 
     if not cookie:
         #cookie not found or expiring soon.  refresh
         log.info('Fetching new Yahoo Finance cookie')
-        response = requests.get("https://fc.yahoo.com", headers=headers, allow_redirects=True)
+        response = session.get("https://fc.yahoo.com", allow_redirects=True)
         if not response.cookies:
             log.error("Failed to obtain Yahoo auth cookie")
         else:
@@ -364,29 +407,59 @@ def getYahooSession():
         expires = datetime.fromtimestamp(cookie.expires)
 
         crumb = None
-        crumb_response = requests.get("https://query2.finance.yahoo.com/v1/test/getcrumb",
-                headers=headers,
-                cookies=yCookies,
-                allow_redirects=True,
-            )
+        crumb_response = session.get("https://query2.finance.yahoo.com/v1/test/getcrumb", allow_redirects=True)   #w/ session cookies
         crumb = crumb_response.text
         if crumb is None:
             log.error("Failed to retrieve Yahoo crumb")
 
-        #save cookie info
+        #save cookie info.  write to a temp file and swap it in, so a crash can't leave a partial file
         cookieData = {'yahooFinance': {'cookie': cookie, 'crumb': crumb}}
-        with open(cookieFile,'wb') as f:
-            pickle.dump(cookieData, f)
+        with open(cookieFile+'.tmp','wb') as f:
+            pickle.dump(cookieData, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cookieFile+'.tmp', cookieFile)
+
+    else:
+        session.cookies.update({cookie.name: cookie.value})
 
     if Debug:
         log.debug('YahooFinance: cookie={cookie}, expires={expires}, crumb={crumb}'.format(
                     cookie=cookie, expires=expires.strftime('%m/%d/%Y'), crumb=crumb)
                  )
-    session = requests.session()
-    session.headers.update(headers)
-    session.cookies.update({cookie.name: cookie.value})
     return session, crumb
 
+def fetchYahooBatch(secs, session, crumb):
+    #get quotes for a list of Securities from the Yahoo v7 quote api, YahooBatchSize symbols per request.
+    #sets status=True for each security returned w/ a valid quote, and status=False for the rest
+    for i in range(0, len(secs), YahooBatchSize):
+        batch = secs[i:i+YahooBatchSize]
+        symbols = ','.join(sec.ticker for sec in batch)
+        if Debug: log.debug('Reading %s for %s' % (YahooBatchURL, symbols))
+
+        try:
+            response = session.get(YahooBatchURL, params={'symbols': symbols, 'crumb': crumb})
+            results = _json.loads(response.content)['quoteResponse']['result']
+        except:
+            if Debug: log.debug('** Error reading Yahoo Finance quotes for %s' % symbols)
+            results = []
+        quotes = {q.get('symbol','').upper(): q for q in results if isinstance(q, dict)}
+
+        for sec in batch:
+            quote = quotes.get(sec.ticker.upper())
+            sec.status = False
+            if quote is None: continue
+            try:
+                sec._setQuote(quote.get('shortName') or quote.get('longName'), quote['symbol'],
+                              quote['regularMarketPrice'],
+                              '%.2f%%' % quote['regularMarketChangePercent'],
+                              quote['regularMarketTime'],
+                              quote['regularMarketPreviousClose'])
+                sec.status = True
+                sec.source = 'Y'
+                sec._logQuote()
+            except:
+                #not formatted as expected?
+                if Debug: log.debug('An error occured when parsing the Yahoo Finance response for %s' % sec.ticker)
+
 #----------------------------------------------------------------------------
 def getQuotes():
 
@@ -412,19 +485,29 @@ def getQuotes():
     yahooSession, yahooCrumb = getYahooSession()
 
     log.info('Getting security and fund quotes')
-    stockList, mfList = [], []
+    stockSecs = [Security(item) for item in stocks]
+    fundSecs  = [Security(item) for item in funds]
+    allSecs   = stockSecs + fundSecs
     with yahooSession:
-        for item in stocks:
-            sec = Security(item)
-            sec.getQuote()
-            status = status and sec.status
-            if sec.status: stockList.append(sec)
-
-        for item in funds:
-            sec = Security(item)
-            sec.getQuote()
-            status = status and sec.status
-            if sec.status: mfList.append(sec)
+        #get quotes YahooBatchSize symbols at a time.  anything the batch api didn't return is
+        #retried w/ a single-symbol request (YahooURL)
+        if eYahoo:
+            fetchYahooBatch(allSecs, yahooSession, yahooCrumb)
+        retry = [sec for sec in allSecs if not (eYahoo and sec.status)]
+
+        #quote requests are i/o bound, so run them in parallel.  limit to 8 at a time, so we don't
+        #get rate-limited by yahoo.  a ticker listed more than once is only fetched once
+        fetched = {}
+        if eYahoo:
+            tickers = list(dict.fromkeys(sec.ticker for sec in retry))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+                fetched = dict(zip(tickers, ex.map(_tryFetchYahooQuote, tickers)))
+        for sec in retry:
+            sec.getQuote(fetched.get(sec.ticker))
+
+    stockList = [sec for sec in stockSecs if sec.status]
+    mfList    = [sec for sec in fundSecs if sec.status]
+    status = status and all(sec.status for sec in stockSecs + fundSecs)
 
     qList = stockList + mfList
 
@@ -444,7 +527,7 @@ def getQuotes():
            writer = OfxWriter(currency, account, 0.001, stockList, mfList)
            writer.writeFile(ofxFile2)
 
-        if glob.glob(ofxFile1) == []:
+        if not os.path.isfile(ofxFile1):
             status = False
 
         # write quotes.htm file
@@ -454,17 +537,14 @@ def getQuotes():
         if status and userdat.savequotehistory:
             csvFile = xfrdir+"QuoteHistory.csv"
             log.info('Appending quote results to {0}'.format(csvFile))
-            newfile = (glob.glob(csvFile) == [])
-            f = open(csvFile,"a")
-            if newfile:
-                f.write('Symbol,Name,Price,Date/Time,LastClose,%Change\n')
-            for s in qList:
+            newfile = not os.path.isfile(csvFile)
+            with open(csvFile, "a", newline='') as f:
+                w = csv.writer(f)   #quotes names that contain commas or quotes
+                if newfile:
+                    w.writerow(['Symbol','Name','Price','Date/Time','LastClose','%Change'])
                 #Fieldnames: symbol, name, price, quoteTime, pclose, pchange
-                t = s.quoteTime
-                t2 = t[4:6]+'/'+t[6:8]+'/'+t[0:4]+' '+ t[8:10]+":"+t[10:12]+":"+t[12:14]
-                line = '"{0}","{1}",{2},{3},{4},{5}\n' \
-                        .format(s.symbol, s.name, s.price, t2, s.pclose, s.pchange)
-                f.write(line)
-            f.close()
+                w.writerows((s.symbol, s.name, s.price,
+                             f'{s.quoteTime[4:6]}/{s.quoteTime[6:8]}/{s.quoteTime[0:4]} {s.quoteTime[8:10]}:{s.quoteTime[10:12]}:{s.quoteTime[12:14]}',
+                             s.pclose, s.pchange) for s in qList)
 
     return status, ofxFile1, ofxFile2, htmFileName
\ No newline at end of file
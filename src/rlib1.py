@@ -25,7 +25,7 @@
 import os, glob, site_cfg, uuid, re, random
 import hashlib, urllib.parse
 import logging, logging.handlers
-import sys, pyDes, pickle
+import sys, pyDes, pickle, threading
 from datetime import datetime
 from control2 import *
 
@@ -82,11 +82,16 @@ def create_logger(name, filename):
 
 #logging handlers <end> ------
 
+_clientUIDLock = threading.Lock()   #connect.key may be updated by parallel downloads
 
 def clientUID(url, username, delKey=False):
     #get clientUID for urlHost+username.  if not exists, create
     #delete key if delKey=True
 
+    with _clientUIDLock:
+        return _clientUID(url, username, delKey)
+
+def _clientUID(url, username, delKey):
     dTable = {}
     found=False
     dfile = 'connect.key'
@@ -367,18 +372,17 @@ NEWFILEUID:NONE
 """
 
 def OfxField(tag,value, ofxver='102'):
-    field = ''
     #skip empty values
-    if tag != '' and value != '':
-        field = '<'+tag+'>'+value
-        #terminate as xml if ofx 2.x
-        if ofxver[0]=='2': field = field + '</'+tag+'>'
-    return field
+    if tag == '' or value == '':
+        return ''
+    #terminate as xml if ofx 2.x
+    if ofxver[0]=='2':
+        return f'<{tag}>{value}</{tag}>'
+    return f'<{tag}>{value}'
 
 def OfxTag(tag,*contents):
-    tag1 = '<' + tag + '>'
-    tag2 = '</' + tag + '>'
-    return '\r\n'.join([tag1]+list(contents)+[tag2])
+    #single join over the open tag, contents and close tag (no intermediate lists)
+    return '\r\n'.join((f'<{tag}>', *contents, f'</{tag}>'))
 
 def dateTimeStr(utc=False, tz=False):
     if utc:
@@ -414,6 +418,36 @@ def validOFX(content):
 
     return msg
 
+#case-insensitive patterns for validOFX_bytes().  whitespace is allowed where validOFX() callers strip it,
+#so the raw file doesn't need to be upper-cased or stripped first
+_vOFX_TEXT_RE    = re.compile(rb'\S')
+_vOFX_OFX_RE     = re.compile(rb'OFXHEADER\s*:|<\s*/?\s*OFX\s*>', re.I)
+_vOFX_ERROR_RE   = re.compile(rb'<\s*SEVERITY\s*>\s*ERROR', re.I)
+_vOFX_DENIED_RE  = re.compile(rb'ACCESS\s*DENIED', re.I)
+_vOFX_INVPOS_RE  = re.compile(rb'<\s*INVPOS\s*>', re.I)
+_vOFX_SECLIST_RE = re.compile(rb'<\s*SECLIST\s*>', re.I)
+
+def validOFX_bytes(data):
+    #same as validOFX(), for raw file data (bytes or mmap).  returns message indicating reason (null if valid)
+    msg=''
+
+    if not _vOFX_TEXT_RE.search(data): msg = 'Null statement received'
+
+    elif not _vOFX_OFX_RE.search(data):
+        msg = 'Invalid OFX statement detected'
+
+    elif _vOFX_ERROR_RE.search(data):
+        msg = 'OFX message contains ERROR condition'
+
+    elif _vOFX_DENIED_RE.search(data):
+        msg = 'Access denied'
+
+    if _vOFX_INVPOS_RE.search(data) and not _vOFX_SECLIST_RE.search(data):
+        #An investment statement must contain a <SECLIST> section when a <INVPOSLIST> section exists
+        msg = "OFX statement contains <INVPOS> record but missing required <SECLIST> section"
+
+    return msg
+
 def int2(str):
     #convert str to int, without throwing exception.  If str is not a "number", returns zero.
     try:
@@ -460,51 +494,42 @@ def combineOfx(ofxList):
     iRe = re.compile('(?:<INVSTMTMSGSRSV1>)(.*?)(?:</INVSTMTMSGSRSV1>)', re.IGNORECASE)
     sRe = re.compile('(?:<SECLIST>)(.*?)(?:</SECLIST>)', re.IGNORECASE)
 
-    bantrn=''
-    crdtrn=''
-    invtrn=''
-    sectrn=''
+    bantrn=[]
+    crdtrn=[]
+    invtrn=[]
+    sectrn=[]
 
     for file in ofxList:
-        if glob.glob(file[2]):
-            f=open(file[2])
-            ofx = f.read()
-            f.close()
+        if os.path.isfile(file[2]):
+            with open(file[2], buffering=1<<20) as f:
+                ofx = f.read()
 
             ofx = ofx.replace(chr(13),'')   #remove CRs
             ofx = ofx.replace(chr(10),'')   #remove LFs
 
-            #create a string for each section found in the file
+            #add statements found in the file to each section
             #re.findall() returns a list of all matching sections
-            b = '\n'.join(bRe.findall(ofx))
-            c = '\n'.join(cRe.findall(ofx))
-            i = '\n'.join(iRe.findall(ofx))
-            s = '\n'.join(sRe.findall(ofx))
-
-            #add statements to each section
-            if b: bantrn = bantrn + '\n' + b
-            if c: crdtrn = crdtrn + '\n' + c
-            if i: invtrn = invtrn + '\n' + i
-            if s: sectrn = sectrn + '\n' + s
-
-    if bantrn: bantrn = OfxTag('BANKMSGSRSV1', bantrn)
-    if crdtrn: crdtrn = OfxTag('CREDITCARDMSGSRSV1', crdtrn)
-    if invtrn: invtrn = OfxTag('INVSTMTMSGSRSV1', invtrn)
-    if sectrn: sectrn = OfxTag('SECLISTMSGSRSV1', OfxTag('SECLIST', sectrn))
+            bantrn.extend(x for x in bRe.findall(ofx) if x)
+            crdtrn.extend(x for x in cRe.findall(ofx) if x)
+            invtrn.extend(x for x in iRe.findall(ofx) if x)
+            sectrn.extend(x for x in sRe.findall(ofx) if x)
+
+    #sections are joined once, rather than appending to a string for each file
+    bantrn = OfxTag('BANKMSGSRSV1', '\n'.join(bantrn)) if bantrn else ''
+    crdtrn = OfxTag('CREDITCARDMSGSRSV1', '\n'.join(crdtrn)) if crdtrn else ''
+    invtrn = OfxTag('INVSTMTMSGSRSV1', '\n'.join(invtrn)) if invtrn else ''
+    sectrn = OfxTag('SECLISTMSGSRSV1', OfxTag('SECLIST', '\n'.join(sectrn))) if sectrn else ''
 
     combOfx = '\n'.join(['<OFX>', signon, bantrn, crdtrn, invtrn, sectrn, '</OFX>'])
 
     #remove blank lines (not required... just to clean it up)
-    combOfx2=''
-    for line in combOfx.splitlines():
-        if line: combOfx2 = combOfx2 + line + '\n'
+    combOfx2 = ''.join(line + '\n' for line in combOfx.splitlines() if line)
 
     combOfx = OfxSGMLHeader() + combOfx2
 
     #there should never be two combined*.ofx files here, but we'll use a unique name just in case
     cfile = xfrdir + 'combined' + str(random.randrange(int(1e5),int(1e6))) + '.ofx'
-    f=open(cfile,'w')
-    f.write(combOfx)
-    f.close()
+    with open(cfile, 'w', buffering=1<<20) as f:
+        f.write(combOfx)
     print(f"Combined OFX created: {cfile}")
     return cfile
\ No newline at end of file
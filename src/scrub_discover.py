@@ -4,6 +4,19 @@ from control2 import *
 from scrubber import scrubPrint
 import re
 
+#dev: insert a line break after each transaction for readability.
+#only used when the tags aren't all upper case (e.g., <stmttrn>).  see _scrubDiscover
+_STMTTRN_RE = re.compile(r'<STMTTRN>',re.IGNORECASE)
+
+#captures everything from <FITID> up to the next <tag>, but excludes the next "<".
+#produces 2 results:  r.group(1) = <FITID> field, r.group(2)=value
+#the ^<\s prevents matching on the next < or newline
+_FITID_RE = re.compile(r'(<FITID>)([^<\s]+)',re.IGNORECASE)
+
+#bank statements: same FITID match as above, or a check coded as a DEBIT (see _scrubDiscover), in one pass
+#   r.group(1,2) = FITID match,  r.group(3,4,5,6) = check match
+_FITID_CHECK_RE = re.compile(r'(<FITID>)([^<\s]+)|(<TRNTYPE>DEBIT)([^\s]+)(<NAME>Check[ ]+)([0-9]+)',re.IGNORECASE)
+
 def scrub(ofx, siteURL, accType):
 
     if 'DISCOVERCARD' in siteURL: ofx= _scrubDiscover(ofx, accType)
@@ -42,77 +55,76 @@ def scrub(ofx, siteURL, accType):
 
 def _scrubDiscover(ofx, accType):
 
-    global _scrub_Discover_knowns  #track of Discover FITID values between regex.sub() calls
-    _scrub_Discover_knowns = []
-
     if accType=='CCSTMT':
         scrubPrint("Scrubber: Processing Discover Card statement.")
     else:
         scrubPrint("Scrubber: Processing Discover Bank statement.")
 
     ofx_final = ''      #new ofx message
-    _scrub_Discover_knowns = []  #reset our global set of known vals (just in case)
+    r1 = _make_r1(accType)  #new set of known FITID vals for this statement
 
     # dev: insert a line break after each transaction for readability.
     # also helps block multi-transaction matching in below regexes via ^\s option
-    p = re.compile(r'(<STMTTRN>)',re.IGNORECASE)
-    ofx = p.sub(r'\n<STMTTRN>', ofx)
-
-    #regex p captures everything from <FITID> up to the next <tag>, but excludes the next "<".
-    #p produces 2 results:  r.group(1) = <FITID> field, r.group(2)=value
-    #the ^<\s prevents matching on the next < or newline
-    p = re.compile(r'(<FITID>)([^<\s]+)',re.IGNORECASE)
+    # tags are almost always upper case, so use str.replace() unless there are some that aren't
+    if ofx.lower().count('<stmttrn>') == ofx.count('<STMTTRN>'):
+        ofx = ofx.replace('<STMTTRN>', '\n<STMTTRN>')
+    else:
+        ofx = _STMTTRN_RE.sub('\n<STMTTRN>', ofx)
 
-    #call substitution (inline lamda, takes regex result = r as tuple)
-    ofx_final = p.sub(lambda r: _scrubDiscover_r1(r, accType), ofx)
+    if accType!='BASTMT':
+        #call substitution (inline lamda, takes regex result = r as tuple)
+        ofx_final = _FITID_RE.sub(r1, ofx)
 
-    if accType=='BASTMT':
-        #regex p captures everything from <TRNTYPE>DEBIT up to the next "<" aftert the <NAME>Check tag and field.
+    else:
+        #FITID and check substitutions are done in a single pass.
+        #the check match captures everything from <TRNTYPE>DEBIT up to the next "<" aftert the <NAME>Check tag and field.
         # Discover Bank codes checks as
         # <STMTTRN><TRNTYPE>DEBIT<...><NAME>Check ###########</STMTTRN>
-        # p produces 4 results:
-        #   r.group(1) = <TRNTYPE>DEBIT,
-        #   r.group(2) = stuff up to next "<NAME>Check "
-        #   r.group(3) = "<NAME>Check ", including the trailing spaces (at least 1)
-        #   r.group(4) is the check number (1 or more digits)
+        # the check match produces 4 results:
+        #   r.group(3) = <TRNTYPE>DEBIT,
+        #   r.group(4) = stuff up to next "<NAME>Check "
+        #   r.group(5) = "<NAME>Check ", including the trailing spaces (at least 1)
+        #   r.group(6) is the check number (1 or more digits)
         # Rearranged, the result should produce a entry that will import the check number in Money
         # <STMTTRN><TRNTYPE>CHECK<...><CHECKNUM>############<NAME>Check</STMTTRN>
-        ofx = ofx_final
-        p = re.compile(r'(<TRNTYPE>DEBIT)([^\s]+)(<NAME>Check[ ]+)([0-9]+)',re.IGNORECASE)
-        ofx_final = p.sub(lambda r: _scrubDiscover_r2(r, accType), ofx)
+        #dispatch on which half of _FITID_CHECK_RE matched
+        ofx_final = _FITID_CHECK_RE.sub(lambda r: r1(r) if r.group(1) is not None else _scrubDiscover_r2(r, r1), ofx)
 
     return ofx_final
 
-def _scrubDiscover_r1(r, accType):
-    #regex subsitution function: change fitid value
-    global _scrub_Discover_knowns
-
-    fieldtag = r.group(1)
-    fitid = r.group(2).strip(' ')
-    fitid_b = fitid                     #base fitid before annotating
-
-    #strip the serial value for credit card transactions
-    if accType=='CCSTMT':
-        bx = len(fitid) - 5
-        fitid_b = fitid[:bx]
-
-    #find a unique serial#, from 0 to 9999
-    seq = 0   #default
-    while seq < 9999:
-        fitid = fitid_b + str(seq)
-        exists = (fitid in _scrub_Discover_knowns)
-        if exists:  #already used it... try another
-            seq=seq+1
-        else:
-            break   #unique value... write it out
-
-    _scrub_Discover_knowns.append(fitid)         #remember the assigned value between calls
-    return fieldtag + fitid             #return the new string for regex.sub()
-
-def _scrubDiscover_r2(r, accType):
+def _make_r1(accType):
+    #returns regex subsitution function: change fitid value
+    #the known FITID values and next serial# for each base value are kept between regex.sub() calls
+    knowns = set()
+    seqs = {}
+    trim = 5 if accType=='CCSTMT' else 0    #strip the serial value for credit card transactions
+
+    def _scrubDiscover_r1(r):
+        fieldtag = r.group(1)
+        fitid = r.group(2)                  #regex excludes whitespace.  no strip needed
+        fitid_b = fitid[:len(fitid)-trim]   #base fitid before annotating
+
+        #find a unique serial#, from 0 to 9999.  serial#s below the saved value for this base are already used,
+        #so start there instead of at 0
+        seq = seqs.get(fitid_b, 0)
+        while seq < 9999:
+            fitid = fitid_b + str(seq)
+            if fitid in knowns:     #already used it... try another
+                seq=seq+1
+            else:
+                break               #unique value... write it out
+
+        knowns.add(fitid)           #remember the assigned value between calls
+        seqs[fitid_b] = seq+1
+        return fieldtag + fitid     #return the new string for regex.sub()
+
+    return _scrubDiscover_r1
+
+def _scrubDiscover_r2(r, r1):
     #regex subsitution function: insert checknum field for BANK statements
-    trntype = r.group(1)
-    rest = r.group(2)
-    name = r.group(3).strip(' ')
-    checknum = r.group(4)
+    trntype = r.group(3)
+    #the check match swallows the transaction's <FITID>, so change it here
+    rest = _FITID_RE.sub(r1, r.group(4))
+    name = r.group(5).strip(' ')
+    checknum = r.group(6)
     return '<TRNTYPE>CHECK' + rest + '<CHECKNUM>' + checknum + name
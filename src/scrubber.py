@@ -53,7 +53,7 @@
 #03Dec2023 cgn
 #   - Update to python3
 
-import re, glob, logging
+import os, re, glob, logging, locale, threading
 import site_cfg
 from datetime import datetime, timedelta
 from control2 import *
@@ -62,11 +62,41 @@ from rlib1 import *
 log = logging.getLogger('root')
 
 userdat = site_cfg.site_cfg()
-stat = False    #global used between re lambda subs to track status
+_quietScrub = userdat.quietScrub    #read once.  sites.dat is loaded at import and doesn't change during a run
+
+#the scrub routines (incl. custom scrub_*.py modules) keep module-level state, so callers on
+#worker threads must hold scrubLock while calling scrub()
+scrubLock = threading.Lock()
+
+#regex patterns used by the scrub routines.  compiled once, at import
+#captures everything from <DT*> up to the next <tag>, but excludes the next "<".
+#produces 2 results:  group(1) = <DT*> field, group(2)=dateval
+_TIME_RE = re.compile(r'(<DT.+?>)([^<\s]+)', re.IGNORECASE)
+#transaction blocks and the tags read from them.  these are plain tag searches (no backtracking), see _tagBlock()
+_INVBUYSELL_RE = re.compile(r'<(INVBUY|INVSELL)>', re.IGNORECASE)
+_REINVEST_RE = re.compile(r'<REINVEST>', re.IGNORECASE)
+_STMTTRN_RE = re.compile(r'<STMTTRN>', re.IGNORECASE)
+_CLOSE_RES = {tag: re.compile('</'+tag+'>', re.IGNORECASE) for tag in ('INVBUY', 'INVSELL', 'REINVEST', 'STMTTRN')}
+_UNITS_RE = re.compile(r'<UNITS>', re.IGNORECASE)
+_TOTAL_RE = re.compile(r'<TOTAL>', re.IGNORECASE)
+_TRNAMT_RE = re.compile(r'<TRNAMT>', re.IGNORECASE)
+#unsupported tags removed by _scrubGeneral()
+_UTAGS = ('CORRECTACTION', 'CORRECTFITID', 'REFNUM', 'SIC')
+#matches an open tag and its value, or a close tag, for any of the unsupported tags
+#produces 2 results:  group(1) = open tag name, group(2) = close tag name (one is None)
+_UTAG_RE = re.compile(r'<(?:(' + '|'.join(_UTAGS) + r')>[^<]*|/(' + '|'.join(_UTAGS) + r')>)', re.IGNORECASE)
+#'&' that isn't part of a valid escape code
+_AMP_RE = re.compile(r'&(?!#?\w+;)')
+#captures <TRNTYPE>, value, and first '<' or white space char
+_TRNTYPE_RE = re.compile(r'(<TRNTYPE>)(.*?)([<\s])', re.IGNORECASE)
+#investment statement (any case)
+_INVSTMTTRNRS_RE = re.compile(r'<INVSTMTTRNRS>', re.IGNORECASE)
+#header lines w/ a space after the colon
+_HEADER_RE = re.compile(r'(^[^<:\n]+:)(\s)([^\n]+)', re.MULTILINE)
 
 def scrubPrint(line):
-    if not userdat.quietScrub:
-        log.info("+ %s" % line)
+    if not _quietScrub:
+        log.info("+ %s", line)
 
 def scrub(filename, site):
     #filename = string
@@ -76,19 +106,15 @@ def scrub(filename, site):
     dtHrs = FieldVal(site, 'timeOffset')
     accType = FieldVal(site, 'CAPS')[1]
     site_skip_zt = FieldVal(site, 'skipzerotrans')
-    with open(filename,'r', newline='') as f:
-        ofx = f.read()  #as-found ofx message
+    ofx = _readOFX(filename)  #as-found ofx message
 
     ofx = _scrubHeader(ofx) #Remove illegal spaces in OFX header lines
 
-    ofx= _scrubTime(ofx)     #fix 000000 and NULL datetime stamps
-
-    if dtHrs != 0: ofx = _scrubShiftTime(ofx, dtHrs)   #note: always call *after* _scrubTime()
-
-    ofx= _scrubDTSTART(ofx)  #fix missing <DTEND> fields
+    ofx= _scrubDates(ofx, dtHrs)    #fix 000000 and NULL datetime stamps, shift DTASOF times, fix missing <DTEND> fields
 
     #fix malformed investment buy/sell/reinvest signs (neg vs pos), if they exist
-    if "<INVSTMTTRNRS>" in ofx.upper():
+    #tags are almost always upper case, so try that first
+    if "<INVSTMTTRNRS>" in ofx or _INVSTMTTRNRS_RE.search(ofx):
         ofx= _scrubINVsign(ofx)
         ofx= _scrubREINVESTsign(ofx)
 
@@ -101,43 +127,89 @@ def scrub(filename, site):
 
     #run custom srub routines
     #any scrub_*.py file found in the current folder will be processed
-    for scrubFile in glob.glob('scrub_*.py'):
-        scrublet = scrubFile.strip('.py')
+    for scrubFile, s in _customScrubs():
+        scrublet = scrubFile[:-3]
         try:
-            s = __import__(scrublet)
             ofx2 = s.scrub(ofx, siteURL, accType)
             if validOFX(ofx2) == '':
                 ofx=ofx2
             else:
                 scrubPrint(scrubFile + ' ERROR: Custom scrub_*.py files must return a valid OFX message.')
+            ofx2 = None     #don't hold a rejected copy while the next module runs
         except Exception as e:
             log.exception('An error occurred when processing scrub module: %s' % scrublet)
 
     #write the new version to the same file
-    with open(filename, 'w') as f:
-        f.write(ofx)
+    _writeOFX(filename, ofx)
 
 #--------------------------------
-def _scrubTime(ofx):
-    #Replace NULL time stamps with noontime (12:00)
+_customScrubList = None     #[(scrubFile, module)], loaded on first use
+
+def _customScrubs():
+    #import the custom scrub_*.py modules once, and reuse them for later scrub() calls
+    global _customScrubList
+    if _customScrubList is None:
+        scrubs = []     #filled before it's published, for scrub() calls on other threads
+        for scrubFile in glob.glob('scrub_*.py'):
+            scrublet = scrubFile[:-3]
+            try:
+                scrubs.append((scrubFile, __import__(scrublet)))
+            except Exception as e:
+                log.exception('An error occurred when processing scrub module: %s' % scrublet)
+        _customScrubList = scrubs
+    return _customScrubList
 
-    #regex p captures everything from <DT*> up to the next <tag>, but excludes the next "<".
-    #p produces 2 results:  group(1) = <DT*> field, group(2)=dateval
-    p = re.compile(r'(<DT.+?>)([^<\s]+)', re.IGNORECASE)
-    #call date correct function (inline lamda, takes regex result = r tuple)
+#--------------------------------
+#file i/o for scrub().  one read/write call for the whole file, instead of going through a buffered text file.
+#same results as open(filename,'r',newline='').read() and open(filename,'w').write()
+_O_BINARY = getattr(os, 'O_BINARY', 0)   #windows: no newline translation at the os level
+
+def _readOFX(filename):
+    fd = os.open(filename, os.O_RDONLY | _O_BINARY)
+    try:
+        data = os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+    return data.decode(locale.getpreferredencoding(False))
+
+def _writeOFX(filename, ofx):
+    if os.linesep != '\n': ofx = ofx.replace('\n', os.linesep)     #text mode newlines
+    data = memoryview(ofx.encode(locale.getpreferredencoding(False)))
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+#--------------------------------
+def _scrubDates(ofx, h):
+    #Fix <DT*> fields, in a single pass over the ofx message:
+    #  1. Replace NULL time stamps with noontime (12:00)
+    #  2. Shift DTASOF time values by (float) h hours, when h != 0.  Applied *after* the noon fix.
+    #  3. <DTSTART> field for an account statement must have a matching <DTEND> field
+    #     If DTEND is missing, insert <DTEND>="now"
+    #     The assumption is made that only one statement exists in the OFX file (no multi-statement files!)
+
+    dtend = ''
+    if '<DTSTART>' in ofx and '<DTEND>' not in ofx:
+        #we have a dtstart, but no dtend... fix it.
+        now = datetime.now()
+        dtend = '<DTEND>%04d%02d%02d%02d%02d00' % (now.year, now.month, now.day, now.hour, now.minute)
 
-    global stat
-    stat = False
-    ofx_final = p.sub(lambda r: _scrubTime_r1(r), ofx)
-    if stat: scrubPrint("Scrubber: Null time values updated.")
+    #call date correct function (inline lamda, takes regex result = r tuple)
+    found = set()   #'noon' and/or 'shift', for the scrub messages
+    ofx_final = _TIME_RE.sub(lambda r: _scrubDates_r1(r, h, dtend, found), ofx)
+    if 'noon' in found: scrubPrint("Scrubber: Null time values updated.")
+    if 'shift' in found: scrubPrint("Scrubber: Shifting DTASOF time values " + str(h) + " hours.")
+    if dtend: scrubPrint("Scrubber: Fixing missing <DTEND> field")
 
     return ofx_final
 
-def _scrubTime_r1(r):
+def _scrubDates_r1(r, h, dtend, found):
     # Replace zero and NULL time fields with a "NOON" timestamp (120000)
     # Force "date" to be the same as the date listed, regardless of time zone by setting time to NOON.
     # Applies when no time is given, and when time == MIDNIGHT (000000)
-    global stat
     fieldtag = r.group(1)
     DT = r.group(2).strip(' ')      #date+time
 
@@ -145,55 +217,24 @@ def _scrubTime_r1(r):
     if DT[8:] == '' or DT[8:14] == '000000':
         #null time given.  Adjust to 120000 value (noon).
         DT = DT[:8] + '120000'
-        stat = True
-
-    return fieldtag + DT
-
-#--------------------------------
-def _scrubDTSTART(ofx):
-    # <DTSTART> field for an account statement must have a matching <DTEND> field
-    # If DTEND is missing, insert <DTEND>="now"
-    # The assumption is made that only one statement exists in the OFX file (no multi-statement files!)
+        found.add('noon')
 
-    ofx_final = ofx
-    now = datetime.now()
-    nowstr = now.strftime("%Y%m%d%H%M00")
+    #fieldtag can take in an empty <DT*> tag ahead of the one that holds the value, so match on the end of it
+    tag = fieldtag.upper()
+    if h != 0 and tag.endswith('<DTASOF>'):
+        DT = _scrubShiftTime(DT, h)
+        found.add('shift')
+    elif dtend and tag.endswith('<DTSTART>'):
+        if Debug: log.debug('DTSTART: %s' % DT)
+        DT += dtend
 
-    if ofx.find('<DTSTART>') >= 0 and ofx.find('<DTEND>') < 0:
-        #we have a dtstart, but no dtend... fix it.
-        scrubPrint("Scrubber: Fixing missing <DTEND> field")
-
-        #regex p captures everything from <DTSTART> up to the next <tag> or white space into group(1)
-        p = re.compile(r'(<DTSTART>[^<\s]+)', re.IGNORECASE)
-        if Debug: log.debug('DTSTART: findall()=%s' % p.findall(ofx_final))
-        #replace group1 with (group1 + <DTEND> + datetime)
-        ofx_final = p.sub(r'\1<DTEND>'+nowstr, ofx_final)
-
-    return ofx_final
-
-def _scrubShiftTime(ofx, h):
-    #Shift DTASOF time values by (float) h hours
-    #Added: 15-Feb-2011, rlc
-
-    #regex p captures everything from <DTASOF> up to the next <tag> or white-space.
-    #p produces 2 results:  group(1) = <DTASOF> field, group(2)=dateval
-    p = re.compile(r'(<DTASOF>)([^<\s]+)', re.IGNORECASE | re.DOTALL)
-
-    #call date correct function (inline lamda, takes regex result = r tuple)
-    if p.search(ofx):
-        scrubPrint("Scrubber: Shifting DTASOF time values " + str(h) + " hours.")
-        ofx_final = p.sub(lambda r: _scrubShiftTime_r1(r,h), ofx)
-
-    return ofx_final
+    return fieldtag + DT
 
-def _scrubShiftTime_r1(r,h):
-    #Shift time value by (float) h hours for regex search result r.
+def _scrubShiftTime(DT, h):
+    #Shift time value DT by (float) h hours.
     #Added: 15-Feb-2011, rlc
 
-    fieldtag = r.group(1)       #date field tag (e.g., <DTASOF>)
-    DT = r.group(2).strip(' ')  #date+time
-
-    if Debug: log.debug('fieldtag=%s | DT=%s' % (fieldtag, DT))
+    if Debug: log.debug('DT=%s' % DT)
 
     # Full date/time format example:  20100730120000.000[-4:EDT]
     #separate into date/time + timezone
@@ -210,13 +251,28 @@ def _scrubShiftTime_r1(r,h):
 
     if Debug: log.debug('New DT=%s | tz=%s' % (DT, tz))
 
-    #shift the time
-    tval = datetime.strptime(DT,"%Y%m%d%H%M%S")  #convert str to datetime
-    deltaT = timedelta(hours=h)
-    tval += deltaT                                        #add hours
-    DT = tval.strftime("%Y%m%d%H%M%S") + tz               #convert new datetime to str
-
-    return fieldtag + DT
+    #shift the time.  the usual 14 digit value is sliced directly (strptime is slow)
+    if len(DT) == 14 and DT.isdigit():
+        tval = datetime(int(DT[0:4]), int(DT[4:6]), int(DT[6:8]), int(DT[8:10]), int(DT[10:12]), int(DT[12:14]))
+    else:
+        tval = datetime.strptime(DT,"%Y%m%d%H%M%S")  #convert str to datetime
+    tval += timedelta(hours=h)                          #add hours
+    return '%04d%02d%02d%02d%02d%02d' % (tval.year, tval.month, tval.day, tval.hour, tval.minute, tval.second) + tz
+
+def _tagBlock(ofx, m, tag):
+    #find the end of the <tag> block opened by match m.
+    #returns (start of </tag>, position after </tag>), or (len(ofx), None) when there's no close tag
+    c = _CLOSE_RES[tag].search(ofx, m.end())
+    return (c.start(), c.end()) if c else (len(ofx), None)
+
+def _tagValue(ofx, tagRE, start, end):
+    #find the first tagRE in ofx[start:end], and return the (start, end) of its value (up to the next '<').
+    #returns None if the tag isn't there or has no value
+    m = tagRE.search(ofx, start, end)
+    if m is None: return None
+    v = ofx.find('<', m.end(), end)
+    if v < 0: v = end
+    return (m.end(), v) if v > m.end() else None
 
 def _scrubINVsign(ofx):
     #Fix malformed parameters in Investment buy/sell sections, if they exist
@@ -230,36 +286,49 @@ def _scrubINVsign(ofx):
     #   UNITS must be negative
     #   TOTAL must be positive
 
-    global stat
-    stat = False
-    p = re.compile(r'(<INVBUY>|<INVSELL>)(.+?<UNITS>)(.+?)(<.+?<TOTAL>)([^<]+)', re.IGNORECASE | re.DOTALL)
-    ofx_final=p.sub(lambda r: _scrubINVsign_r1(r), ofx)
-    if stat:
-        scrubPrint("Scrubber: Invalid investment sign (pos/neg) found.  Corrected.")
-
-    return ofx_final
-
-def _scrubINVsign_r1(r):
-
-    global stat
-    type=""
-    if "INVBUY"  in r.group(1): type = "INVBUY"
-    if "INVSELL" in r.group(1): type = "INVSELL"
-    qty = r.group(3)
-    total=r.group(5)
-
-    qty_v=float2(qty)
-    total_v=float2(total)
-
-    if (type=="INVBUY" and qty_v<0) or (type=="INVSELL" and qty_v>0):
-        stat=True
-        qty=str(-1*qty_v)
-
-    if (type=="INVBUY" and total_v>0) or (type=="INVSELL" and total_v<0):
-        stat=True
-        total=str(-1*total_v)
-
-    return r.group(1) + r.group(2) + qty + r.group(4) + total
+    #each <INVBUY>/<INVSELL> block is checked on its own.  <UNITS> comes before <TOTAL>
+    fixed = []
+    parts = []
+    done = 0        #ofx has been copied to parts up to here
+    pos = 0
+    while True:
+        m = _INVBUYSELL_RE.search(ofx, pos)
+        if m is None: break
+        end, pos = _tagBlock(ofx, m, m.group(1).upper())
+        if pos is None: pos = end
+        qty = _tagValue(ofx, _UNITS_RE, m.end(), end)
+        total = _tagValue(ofx, _TOTAL_RE, qty[1], end) if qty else None
+        if total:
+            new = _scrubINVsign_r1(m.group(0), ofx[qty[0]:qty[1]], ofx[total[0]:total[1]], fixed)
+            if new:
+                parts += (ofx[done:qty[0]], new[0], ofx[qty[1]:total[0]], new[1])
+                done = total[1]
+
+    if not fixed: return ofx
+    parts.append(ofx[done:])
+    scrubPrint("Scrubber: Invalid investment sign (pos/neg) found.  Corrected.")
+    return ''.join(parts)
+
+def _scrubINVsign_r1(tag, qty, total, fixed):
+    #returns corrected (qty, total) strings, or None if no change is needed
+    #sign = +1 for INVBUY, -1 for INVSELL:  UNITS should have that sign, TOTAL the opposite
+    if tag == "<INVBUY>": sign = 1
+    elif tag == "<INVSELL>": sign = -1
+    else: return None
+
+    #float2(), inlined.  these run once per transaction
+    try: qty_v=float(qty)
+    except ValueError: qty_v=0.0
+    try: total_v=float(total)
+    except ValueError: total_v=0.0
+    qty_bad = qty_v*sign < 0
+    total_bad = total_v*sign > 0
+    if not (qty_bad or total_bad):
+        return None         #signs are already correct.  leave the text as-is
+
+    fixed.append(True)
+    return (str(-1*qty_v) if qty_bad else qty,
+            str(-1*total_v) if total_bad else total)
 
 def _scrubREINVESTsign(ofx):
     #Fix malformed parameters in REINVEST transactions, if they exist
@@ -269,111 +338,126 @@ def _scrubREINVESTsign(ofx):
     #   UNITS must be positive
     #   TOTAL must be negative
 
-    global stat
-    stat=False
-    p = re.compile(r'(<REINVEST>)(.+?<TOTAL>)(.+?)(<.+?<UNITS>)([^<]+)', re.IGNORECASE | re.DOTALL)
-    ofx_final=p.sub(lambda r: _scrubREINVESTsign_r1(r), ofx)
-    if stat:
-        scrubPrint("  +Scrubber: Invalid reinvestment sign (pos/neg) found.  Corrected.")
-
-    return ofx_final
-
-def _scrubREINVESTsign_r1(r):
-    global stat
-    qty = r.group(5)
-    total=r.group(3)
-
-    qty_v=float2(qty)
-    total_v=float2(total)
-
-    if (qty_v<0):
-        stat=True
-        qty=str(-1*qty_v)
-
-    if (total_v>0):
-        stat=True
-        total=str(-1*total_v)
-
-    return r.group(1) + r.group(2) + total + r.group(4) + qty
+    #each <REINVEST> block is checked on its own.  <TOTAL> comes before <UNITS>
+    fixed = []
+    parts = []
+    done = 0        #ofx has been copied to parts up to here
+    pos = 0
+    while True:
+        m = _REINVEST_RE.search(ofx, pos)
+        if m is None: break
+        end, pos = _tagBlock(ofx, m, 'REINVEST')
+        if pos is None: pos = end
+        total = _tagValue(ofx, _TOTAL_RE, m.end(), end)
+        qty = _tagValue(ofx, _UNITS_RE, total[1], end) if total else None
+        if qty:
+            new = _scrubREINVESTsign_r1(ofx[total[0]:total[1]], ofx[qty[0]:qty[1]], fixed)
+            if new:
+                parts += (ofx[done:total[0]], new[0], ofx[total[1]:qty[0]], new[1])
+                done = qty[1]
+
+    if not fixed: return ofx
+    parts.append(ofx[done:])
+    scrubPrint("  +Scrubber: Invalid reinvestment sign (pos/neg) found.  Corrected.")
+    return ''.join(parts)
+
+def _scrubREINVESTsign_r1(total, qty, fixed):
+    #returns corrected (total, qty) strings, or None if no change is needed
+    #float2(), inlined.  these run once per transaction
+    try: qty_v=float(qty)
+    except ValueError: qty_v=0.0
+    try: total_v=float(total)
+    except ValueError: total_v=0.0
+    if not (qty_v<0 or total_v>0):
+        return None         #signs are already correct.  leave the text as-is
+
+    fixed.append(True)
+    return (str(-1*total_v) if total_v>0 else total,
+            str(-1*qty_v) if qty_v<0 else qty)
 
 def _scrubGeneral(ofx):
     # General scrub routine for general updates
 
     #1. Remove tag/value pairs that Money doesn't support
-    #define unsupported tags that we've had trouble with
-    global stat
-    uTags = []
-    uTags.append('CORRECTACTION')
-    uTags.append('CORRECTFITID')
-    uTags.append('REFNUM')
-    uTags.append('SIC')
-
-    for tag in uTags:
-        # Remove open tag and value
-        p = re.compile(r'<'+tag+'>[^<]*', re.IGNORECASE)
-        if p.search(ofx):
-            ofx = p.sub('',ofx)
-            scrubPrint("Scrubber: <"+tag+"> tags removed.  Not supported by Money.")
-        # Remove close tag (if any) [could probably create a very smart RE to merge these two REs]
-        p = re.compile(r'</'+tag+'>',re.IGNORECASE)
-        if p.search(ofx):
-            ofx = p.sub('',ofx)
-            scrubPrint("Scrubber: </"+tag+"> closing tags removed.")
+    #unsupported tags that we've had trouble with are defined in _UTAGS
+    #open tags (w/ value) and close tags for all of them are removed in a single pass
+    found = set()   #('<' or '</', tag) for each kind of tag removed
+    ofx = _UTAG_RE.sub(lambda r: _scrubGeneral_r2(r, found), ofx)
+    if found and not _quietScrub:
+        for tag in _UTAGS:
+            if ('<', tag) in found: scrubPrint("Scrubber: <"+tag+"> tags removed.  Not supported by Money.")
+            if ('</', tag) in found: scrubPrint("Scrubber: </"+tag+"> closing tags removed.")
 
     #2. Replace ampersands '&' that aren't part of a valid escape code (i.e., is NOT like &amp;, &#012; etc)
     #   literally:  replace '&' chars with '&amp;' when the next chars are not
     #               a '#' or valid alphanumerics followed by a ;
-    p = re.compile(r'&(?!#?\w+;)')
-    if p.search(ofx):
+    if '&' in ofx and _AMP_RE.search(ofx):
         scrubPrint("Scrubber: Replace invalid '&' chars with '&amp;'")
-        ofx = p.sub('&amp;',ofx)
+        ofx = _AMP_RE.sub('&amp;',ofx)
 
     #3. Replace null or missing <TRNTYPE> with 'OTHER'
-    #   regex captures <TRNTYPE>, value, and first '<' or white space char
-    p = re.compile(r'(<TRNTYPE>)(.*?)([<\s])', re.IGNORECASE)
-    if p.search(ofx):
-        stat=False
-        ofx = p.sub(lambda r: _scrubGeneral_r1(r), ofx)
-        if stat: scrubPrint("Null or missing TRNTYPE replaced with 'OTHER' ")
+    if _TRNTYPE_RE.search(ofx):
+        fixed = []
+        ofx = _TRNTYPE_RE.sub(lambda r: _scrubGeneral_r1(r, fixed), ofx)
+        if fixed: scrubPrint("Null or missing TRNTYPE replaced with 'OTHER' ")
     return ofx
 
-def _scrubGeneral_r1(r):
+def _scrubGeneral_r1(r, fixed):
     # replace null or missing TRNTYPE with 'OTHER'
-    global stat
     trntype = r.group(2)
     if trntype.upper() in ('NULL',''):
         trntype='OTHER'
-        stat=True
+        fixed.append(True)
     return r.group(1) + trntype + r.group(3)
 
+def _scrubGeneral_r2(r, found):
+    # remove unsupported tag, and remember which one for the scrub message
+    if r.group(1) is not None:
+        found.add(('<', r.group(1).upper()))
+    else:
+        found.add(('</', r.group(2).upper()))
+    return ''
+
 def _scrubRemoveZeroTrans(ofx):
     #Remove transactions with a $0.00 value
-
-    #regex p captures transaction records
-    #p produces 3 results:  group(1) = trans header, group(2)=Amount, group(3)=trans suffix
-
-    global stat
-    stat=False
-    p = re.compile(r'(<STMTTRN>.*?<TRNAMT>)(.+?)(<.*?</STMTTRN>)', re.DOTALL | re.IGNORECASE)
-
-    ofx = p.sub(lambda r: _scrubRemoveZeroTrans_r1(r), ofx)
-    if stat: scrubPrint('Zero amount ($0.00) transactions removed.')
-    return ofx
-
-def _scrubRemoveZeroTrans_r1(r):
-    # return null transaction when amount=0
-    global stat
-    amount = float2(r.group(2))
-    if amount==0: stat=True
-    return None if amount==0 else r.group(1)+r.group(2)+r.group(3)
+    #each <STMTTRN> block is checked on its own, and dropped (through </STMTTRN>) when <TRNAMT> is zero
+
+    parts = []
+    done = 0        #ofx has been copied to parts up to here
+    pos = 0
+    while True:
+        m = _STMTTRN_RE.search(ofx, pos)
+        if m is None: break
+        end, pos = _tagBlock(ofx, m, 'STMTTRN')
+        if pos is None: break       #no </STMTTRN>.  leave it
+        amt = _tagValue(ofx, _TRNAMT_RE, m.end(), end)
+        if amt and _isZeroAmount(ofx[amt[0]:amt[1]]):
+            parts.append(ofx[done:m.start()])
+            done = pos
+
+    if not parts: return ofx
+    parts.append(ofx[done:])
+    scrubPrint('Zero amount ($0.00) transactions removed.')
+    return ''.join(parts)
+
+def _isZeroAmount(amt):
+    # same result as float2(amt)==0, without the float conversion for plain decimal values (e.g., -12.34)
+    t = amt.strip()
+    if t[:1] in ('+','-'): t = t[1:]
+    if t.isascii() and t.replace('.','',1).isdigit():
+        return t.strip('0.') == ''
+    return float2(amt)==0   #anything else (exponents, junk, ...)
 
 def _scrubHeader(ofx):
     # Look for header lines that have space after the colon.
-    #(we look based on format, in theory the RE could find them in the wrong place)
-    p = re.compile(r'(^[^<:\n]+:)(\s)([^\n]+)', re.MULTILINE)
-    if p.search(ofx):
+    #(we look based on format.  only the lines ahead of the one w/ the first <tag> are searched,
+    # so the RE can't find them in the wrong place)
+    end = ofx.find('<')
+    end = len(ofx) if end < 0 else ofx.rfind('\n', 0, end) + 1
+    header = ofx[:end]
+    if _HEADER_RE.search(header):
         # Remove the space
-        result = p.subn(r'\1\3',ofx)
-        ofx = result[0]
+        result = _HEADER_RE.subn(r'\1\3',header)
+        ofx = result[0] + ofx[end:]
         scrubPrint("Scrubber: Removed spaces in " + str(result[1]) + " header lines.")
     return ofx
@@ -116,6 +116,9 @@ class site_cfg:
         self.skipFailedLogon = True
         self.promptStart = True
         self.promptEnd   = False
+        self.maxParallelDownloads = 4
+        self.uploadGapMs = 500
+        self.useHTTP2 = False
 
         if glob.glob(self.datfile) == []:
             if glob.glob(self.bakfile) != []:
@@ -162,6 +165,7 @@ class site_cfg:
                 skipzerotrans = None
                 useragent = None
                 clientuid = None
+                batchstmt = False
 
             if '<SITE>' in lineU:
                 parsing = True
@@ -185,7 +189,8 @@ class site_cfg:
                       'SKIPZEROTRANS': skipzerotrans,
                            'DTACCTUP': dtacctup,
                           'USERAGENT': useragent,
-                          'CLIENTUID': clientuid        }
+                          'CLIENTUID': clientuid,
+                          'BATCHSTMT': batchstmt        }
                         }
                     self.sites.update(X)
 
@@ -212,6 +217,7 @@ class site_cfg:
                     elif field == 'DTACCTUP': dtacctup = value
                     elif field == 'USERAGENT': useragent = value
                     elif field == 'CLIENTUID': clientuid = value
+                    elif field == 'BATCHSTMT': batchstmt = 'Y' in value.upper()
 
                 else:
                     #look for individual parameters while we're NOT parsing site info
@@ -272,6 +278,15 @@ class site_cfg:
                     if field == 'PROMPTEND':
                         self.promptEnd = (value[:1].upper() == 'Y')
 
+                    if field == 'MAXPARALLELDOWNLOADS':
+                        self.maxParallelDownloads = max(1, int2(value))
+
+                    if field == 'UPLOADGAPMS':
+                        self.uploadGapMs = max(0, int2(value))
+
+                    if field == 'USEHTTP2':
+                        self.useHTTP2 = (value[:1].upper() == 'Y')
+
            #end_for line
 
         f.close()